@@ -0,0 +1,83 @@
+# Microbenchmark: 3-argument handlers vs message_handler handlers
+# Run: python benchmarks/message_handlers.py [messages] [handlers]
+#
+# Uses an offline Broker (connect=False) and feeds synthetic messages through
+# on_message. Every topic has several handlers. Classic handlers each get a
+# freshly built url string, message handlers share one Message per message.
+# The "retained" run keeps what handlers receive (like a queue consumer),
+# which shows the per-message allocations that stay alive.
+
+import os
+import sys
+import time
+import tracemalloc
+
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from dataspace_client import Broker, message_handler
+
+MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+HANDLERS = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+TOPICS = 100
+
+
+def make_message(topic, payload):
+    msg = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+    msg.payload = payload
+    return msg
+
+
+def make_broker(as_message, retained):
+    broker = Broker("localhost", 1883, None, None, "datadirectory", connect=False)
+    broker.cache = False
+
+    for h in range(HANDLERS):
+        if as_message:
+            if retained is not None:
+                def handler(msg):
+                    retained.append(msg)
+            else:
+                def handler(msg):
+                    pass
+            handler = message_handler(handler)
+        else:
+            if retained is not None:
+                def handler(url, payload, msg_type):
+                    retained.append((url, payload, msg_type))
+            else:
+                def handler(url, payload, msg_type):
+                    pass
+
+        for i in range(TOPICS):
+            broker.Subscribe(f"datadirectory/bench/{i}", handler)
+    return broker
+
+
+messages = [make_message(f"datadirectory/bench/{i}", b'{"value": 1}') for i in range(TOPICS)]
+
+
+def run_timed(as_message):
+    broker = make_broker(as_message, None)
+    start = time.perf_counter()
+    for n in range(MESSAGES):
+        broker.on_message(None, None, messages[n % TOPICS])
+    return (time.perf_counter() - start) / MESSAGES * 1e6
+
+
+def run_retained(as_message):
+    retained = []
+    broker = make_broker(as_message, retained)
+    count = MESSAGES // 10
+    tracemalloc.start()
+    for n in range(count):
+        broker.on_message(None, None, messages[n % TOPICS])
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current / count
+
+
+print(f"{MESSAGES} messages, {HANDLERS} handlers per topic")
+print(f"{'handler':>10} {'us/msg':>8} {'retained B/msg':>15}")
+for name, as_message in (("3-arg", False), ("Message", True)):
+    print(f"{name:>10} {run_timed(as_message):>8.2f} {run_retained(as_message):>15.0f}")
@@ -0,0 +1,83 @@
+# Soak benchmark for pending Get bookkeeping
+# Run: python benchmarks/soak_gets.py [number_of_gets]
+#
+# Uses an offline Broker (connect=False) and drives it through Broker.Get.
+# A feeder thread plays the server: once a Get has subscribed it feeds the
+# answer through on_message. Every tenth blocking Get and every tenth
+# non-blocking Get is left to time out. Memory, pending Gets, subscriptions
+# and threads should stay flat and end at zero.
+
+import os
+import gc
+import sys
+import time
+import queue
+import threading
+
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from dataspace_client import Broker
+
+TOTAL = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+REPORT_EVERY = max(TOTAL // 10, 1)
+TOPICS = 1000
+MISSING_TIMEOUT = 0.001
+
+
+def make_message(topic, payload):
+    msg = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+    msg.payload = payload
+    return msg
+
+
+broker = Broker("localhost", 1883, None, None, "datadirectory", connect=False)
+broker.missing_ttl = 0   # topics that timed out are asked again
+messages = [make_message(f"datadirectory/soak/{i}", b'{"value": 1}') for i in range(TOPICS)]
+feed = queue.Queue()
+
+
+def feeder():
+    while True:
+        i = feed.get()
+        if i is None:
+            return
+        # Answer once the Get has subscribed, like a retained message would
+        while not broker.has_subscribers(messages[i].topic):
+            time.sleep(0)
+        broker.on_message(None, None, messages[i])
+
+
+threading.Thread(target=feeder, daemon=True).start()
+
+start = last = time.perf_counter()
+answered = 0
+
+print(f"{'gets':>10} {'us/get':>8} {'pending':>8} {'subs':>6} {'threads':>8} {'gc objects':>11}")
+
+for n in range(1, TOTAL + 1):
+    i = n % TOPICS
+    topic = messages[i].topic
+
+    if n % 10 == 0:
+        # Blocking Get that times out
+        broker.Get(topic, handler=None, timeout=MISSING_TIMEOUT)
+    elif n % 10 == 5:
+        # Non-blocking Get that times out, its timer cancels it
+        broker.Get(topic, blocking=False, handler=None, timeout=MISSING_TIMEOUT)
+    else:
+        feed.put(i)
+        if broker.Get(topic, handler=None, timeout=5) is not None:
+            answered += 1
+
+    if n % REPORT_EVERY == 0:
+        now = time.perf_counter()
+        print(f"{n:>10} {(now - last) / REPORT_EVERY * 1e6:>8.2f} {len(broker.gets):>8} "
+              f"{len(broker.subscriptions):>6} {threading.active_count():>8} {len(gc.get_objects()):>11}")
+        last = time.perf_counter()
+
+feed.put(None)
+time.sleep(0.5)   # let the last non-blocking deadlines fire
+
+print(f"Total: {time.perf_counter() - start:.1f} s, answered {answered}, "
+      f"left pending {len(broker.gets)}, subscriptions {len(broker.subscriptions)}")
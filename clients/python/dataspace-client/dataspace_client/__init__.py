@@ -6,12 +6,15 @@ import traceback
 import time
 import datetime
 import pytz
-import io
 import threading
+import atexit
+import weakref
+import warnings
+import queue
+import asyncio
 #import pandas as pd
 import uuid
 #from IPython.display import Image, display
-import imghdr
 from urllib.parse import urlparse
 from ast import Pass
 #from pythreejs import *
@@ -22,11 +25,28 @@ import base64
 #import ipywidgets as widgets
 #from IPython.display import display, HTML
 import uuid
+import re
+import sys
+import itertools
+import heapq
+import copy
+import hashlib
+import zlib
+import os
+import sqlite3
+import tempfile
+import concurrent.futures
+import socket
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.subscribeoptions import SubscribeOptions
+from collections import OrderedDict, deque
+from collections.abc import Mapping
 from jsonpath_ng import parse as jsonpath_parse
 from enum import Enum
 
 
-__all__ = ["DataHub", "datahub", "__version__"]
+__all__ = ["DataHub", "AsyncDataHub", "Message", "message_handler", "datahub", "GET_TIMEOUT", "__version__"]
 __version__ = "0.1.3.15"
 
 #Enum that describes 3 states 0 public, 1 private, 2 cached data
@@ -68,9 +88,30 @@ if  _is_notebook:
     import ipywidgets as widgets
 
 
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+
 def payload_is_jpg(data):
-    o = io.BytesIO(data)
-    return imghdr.what(o) == "jpeg"
+    # Only the first bytes are compared, the payload itself is not copied
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:3]) == JPEG_MAGIC
+
+
+def payload_view(payload):
+    """Read-only memoryview of a payload, shares memory with it (str is encoded first)."""
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    view = memoryview(payload)
+    return view if view.readonly else view.toreadonly()
+
+
+def write_payload(payload, path):
+    """Write a payload to path straight from its buffer, returns the number of bytes."""
+    view = payload_view(payload)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(view)
+    os.replace(tmp, path)
+    return view.nbytes
 
 lastpayload = None
 
@@ -87,6 +128,9 @@ def default_handler(topic, payload, msg_type: message_type):
     is_binary = isinstance(payload, (bytes, bytearray))
     is_python = not is_binary  # JSONPath results or retained JSON objects
 
+    # Kind from topic extension / magic bytes, JSON and text decoded lazily at most once
+    view = PayloadView(topic, payload)
+
     # ---------------------------------------------------------
     # 2. DIRECTORY LISTING (python or json)
     # ---------------------------------------------------------
@@ -97,10 +141,7 @@ def default_handler(topic, payload, msg_type: message_type):
 
         # Case 2: payload is binary JSON representing list/dict
         else:
-            try:
-                entries = json.loads(payload)
-            except Exception:
-                entries = None
+            entries = view.json
 
         if isinstance(entries, (list, dict)):
             folder_emoji = "\U0001F4C1"
@@ -147,7 +188,7 @@ def default_handler(topic, payload, msg_type: message_type):
     # 5. GLB preview
     # ---------------------------------------------------------
     try:
-        if topic.lower().endswith(".glb"):
+        if view.kind == "glb":
             print("File size is: " + str(len(payload)))
             show_3d_model(payload)
             return
@@ -157,21 +198,16 @@ def default_handler(topic, payload, msg_type: message_type):
     # ---------------------------------------------------------
     # 6. Try to pretty-print JSON
     # ---------------------------------------------------------
-    try:
-        data = json.loads(payload)
-        print(json.dumps(data, indent=2))
+    if view.is_json:
+        print(json.dumps(view.json, indent=2))
         return
-    except:
-        pass
 
     # ---------------------------------------------------------
     # 7. Try to print as UTF-8 string
     # ---------------------------------------------------------
-    try:
-        print(payload.decode("utf-8"))
+    if view.text is not None:
+        print(view.text)
         return
-    except:
-        pass
 
     # ---------------------------------------------------------
     # 8. Fallback: raw bytes
@@ -274,6 +310,1968 @@ def show_3d_model(glb_data):
 
 
 
+# ---------------------------------------------------------
+# Compiled JSONPath cache
+# ---------------------------------------------------------
+
+# One step of a simple path: .name, [3], ['key'] or ["key"]
+_SIMPLE_JSONPATH_STEP = re.compile(
+    r"""\.([A-Za-z_][\w\-]*)|\[(\d+)\]|\['([^'\\]*)'\]|\["([^"\\]*)"\]"""
+)
+
+
+class SimpleJsonPath:
+    """Hand-rolled evaluator for plain paths like $.a.b, $.a[3] and $['key'].
+
+    Behaves like the jsonpath_ng expression for the same string: find() returns
+    the matched values and update() only replaces values that already exist.
+    """
+
+    __slots__ = ("path", "steps")
+
+    def __init__(self, path, steps):
+        self.path = path
+        self.steps = steps
+
+    @classmethod
+    def compile(cls, path):
+        """Return a SimpleJsonPath, or None if the path needs jsonpath_ng."""
+        if not path or path[0] != "$":
+            return None
+
+        steps = []
+        pos = 1
+        while pos < len(path):
+            m = _SIMPLE_JSONPATH_STEP.match(path, pos)
+            if m is None:
+                return None
+            name, index, quoted1, quoted2 = m.groups()
+            if index is not None:
+                steps.append(int(index))
+            elif name is not None:
+                steps.append(name)
+            else:
+                steps.append(quoted1 if quoted1 is not None else quoted2)
+            pos = m.end()
+
+        return cls(path, tuple(steps))
+
+    @staticmethod
+    def _step(data, step):
+        # Returns (found, value)
+        if isinstance(step, int):
+            if isinstance(data, (list, str)) and step < len(data):
+                return True, data[step]
+        elif isinstance(data, dict) and step in data:
+            return True, data[step]
+        return False, None
+
+    def find(self, data):
+        for step in self.steps:
+            found, data = self._step(data, step)
+            if not found:
+                return []
+        return [data]
+
+    def update(self, data, value):
+        if not self.steps:
+            return value
+
+        parent = data
+        for step in self.steps[:-1]:
+            found, parent = self._step(parent, step)
+            if not found:
+                return data
+
+        last = self.steps[-1]
+        if isinstance(last, int):
+            if isinstance(parent, list) and last < len(parent):
+                parent[last] = value
+        elif isinstance(parent, dict) and last in parent:
+            parent[last] = value
+        return data
+
+
+class JsonPathCache:
+    """Bounded, thread-safe LRU of compiled JSONPath expressions keyed by path string.
+
+    Simple paths are compiled to a SimpleJsonPath and never touch jsonpath_ng;
+    filters, wildcards and recursive descent fall back to jsonpath_ng.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._compiled = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.fast_path = 0
+        self.slow_path = 0
+
+    def compile(self, path):
+        with self._lock:
+            expr = self._compiled.get(path)
+            if expr is not None:
+                self._compiled.move_to_end(path)
+                self.hits += 1
+                self._count_path(expr)
+                return expr
+            self.misses += 1
+
+        # Compile outside the lock, a duplicate compile on a race is harmless
+        expr = SimpleJsonPath.compile(path)
+        if expr is None:
+            expr = jsonpath_parse(path)
+
+        with self._lock:
+            self._compiled[path] = expr
+            self._compiled.move_to_end(path)
+            while len(self._compiled) > self.maxsize:
+                self._compiled.popitem(last=False)
+            self._count_path(expr)
+        return expr
+
+    def _count_path(self, expr):
+        # Called with the lock held
+        if isinstance(expr, SimpleJsonPath):
+            self.fast_path += 1
+        else:
+            self.slow_path += 1
+
+    def find(self, path, data):
+        """Return the list of matched values for path in data."""
+        expr = self.compile(path)
+        if isinstance(expr, SimpleJsonPath):
+            return expr.find(data)
+        return [m.value for m in expr.find(data)]
+
+    def update(self, path, data, value):
+        return self.compile(path).update(data, value)
+
+    def clear(self):
+        with self._lock:
+            self._compiled.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._compiled),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "fast_path": self.fast_path,
+                "slow_path": self.slow_path,
+            }
+
+
+# Shared by all brokers, compiled expressions do not depend on the server
+jsonpath_cache = JsonPathCache()
+
+
+# ---------------------------------------------------------
+# Topic routing (MQTT + and # wildcards)
+# ---------------------------------------------------------
+
+def has_wildcards(topic_filter):
+    return "+" in topic_filter or "#" in topic_filter
+
+
+def topic_matches(topic_filter, topic):
+    """Check a single topic against a single MQTT filter."""
+    filter_levels = topic_filter.split("/")
+    levels = topic.split("/")
+
+    # Wildcards in the first level never match $-topics
+    if topic.startswith("$") and filter_levels[0] in ("+", "#"):
+        return False
+
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(levels):
+            return False
+        if level != "+" and level != levels[i]:
+            return False
+    return len(filter_levels) == len(levels)
+
+
+class _TopicNode:
+    __slots__ = ("children", "topic_filter")
+
+    def __init__(self):
+        self.children = {}
+        self.topic_filter = None   # Set when a filter ends at this node
+
+
+class TopicRouter:
+    """Trie of subscribed topic filters.
+
+    match() walks one trie level per topic level, so the cost of routing a
+    message depends on the depth of the topic and not on how many filters
+    are subscribed.
+    """
+
+    def __init__(self, private_prefix=None):
+        self.private_prefix = private_prefix
+        self._root = _TopicNode()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, topic_filter):
+        node = self._root
+        for level in topic_filter.split("/"):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _TopicNode()
+            node = child
+        if node.topic_filter is None:
+            self._count += 1
+        node.topic_filter = topic_filter
+
+    def remove(self, topic_filter):
+        path = [self._root]
+        levels = topic_filter.split("/")
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+
+        if path[-1].topic_filter is None:
+            return
+        path[-1].topic_filter = None
+        self._count -= 1
+
+        # Prune nodes that no longer lead to any filter
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if node.children or node.topic_filter is not None:
+                break
+            del path[i - 1].children[levels[i - 1]]
+
+    def match(self, topic):
+        """Return all subscribed filters that match topic."""
+        levels = topic.split("/")
+        depth_max = len(levels)
+        matches = []
+        dollar = topic.startswith("$")
+
+        stack = [(self._root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            children = node.children
+
+            # Wildcards in the first level never match $-topics
+            if not (dollar and depth == 0):
+                hash_node = children.get("#")
+                if hash_node is not None and hash_node.topic_filter is not None:
+                    matches.append(hash_node.topic_filter)
+
+            if depth == depth_max:
+                if node.topic_filter is not None:
+                    matches.append(node.topic_filter)
+                continue
+
+            child = children.get(levels[depth])
+            if child is not None:
+                stack.append((child, depth + 1))
+
+            if not (dollar and depth == 0):
+                child = children.get("+")
+                if child is not None:
+                    stack.append((child, depth + 1))
+
+        return matches
+
+    def route(self, msg_topic):
+        """Strip the private prefix and match in one step.
+
+        Returns (topic, is_private, matching_filters).
+        """
+        prefix = self.private_prefix
+        if prefix and msg_topic.startswith(prefix):
+            topic = msg_topic[len(prefix):]
+            return topic, True, self.match(topic)
+        return msg_topic, False, self.match(msg_topic)
+
+
+# ---------------------------------------------------------
+# Payload cache (byte budget, LRU, TTL, pinning)
+# ---------------------------------------------------------
+
+class CacheEntry:
+    __slots__ = ("payload", "ts", "msg_type", "size")
+
+    def __init__(self, payload, ts, msg_type, size):
+        self.payload = payload
+        self.ts = ts
+        self.msg_type = msg_type
+        self.size = size
+
+
+def _payload_size(topic, payload):
+    try:
+        size = len(payload)
+    except TypeError:
+        size = sys.getsizeof(payload)
+    return size + len(topic)
+
+
+class _CacheFieldView(Mapping):
+    """Read-only topic → field mapping over a PayloadCache (e.g. cached_ts)."""
+
+    def __init__(self, cache, field):
+        self._cache = cache
+        self._field = field
+
+    def __getitem__(self, topic):
+        entry = self._cache.get_entry(topic)
+        if entry is None:
+            raise KeyError(topic)
+        return getattr(entry, self._field)
+
+    def __iter__(self):
+        return iter(self._cache.keys())
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class PayloadCache:
+    """Last payload per topic with a byte budget.
+
+    The least recently used topics are evicted when max_bytes is exceeded,
+    except topics for which is_pinned(topic) is true (live subscriptions).
+    TTLs can be set per topic or per topic prefix and are checked against
+    the timestamp stored with each payload.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, is_pinned=None):
+        self.max_bytes = max_bytes
+        self.is_pinned = is_pinned
+        self.size_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._ttls = {}   # topic or prefix → seconds
+
+    def set_ttl(self, topic_or_prefix, seconds):
+        """Expire cached payloads under topic_or_prefix after seconds, None removes the TTL."""
+        with self._lock:
+            if seconds is None:
+                self._ttls.pop(topic_or_prefix, None)
+            else:
+                self._ttls[topic_or_prefix] = seconds
+
+    def ttl_for(self, topic):
+        # The longest matching prefix wins
+        best = None
+        best_len = -1
+        for prefix, seconds in self._ttls.items():
+            if len(prefix) > best_len and topic.startswith(prefix):
+                best, best_len = seconds, len(prefix)
+        return best
+
+    def put(self, topic, payload, msg_type, ts=None):
+        entry = CacheEntry(payload, time.time() if ts is None else ts, msg_type,
+                           _payload_size(topic, payload))
+        with self._lock:
+            old = self._entries.pop(topic, None)
+            if old is not None:
+                self.size_bytes -= old.size
+            self._entries[topic] = entry
+            self.size_bytes += entry.size
+            if self.size_bytes > self.max_bytes:
+                self._evict()
+        return entry
+
+    def _evict(self):
+        # Called with the lock held. Pinned topics are moved to the MRU end so
+        # each entry is looked at no more than once per eviction pass.
+        remaining = len(self._entries)
+        while self.size_bytes > self.max_bytes and remaining > 0:
+            remaining -= 1
+            topic, entry = next(iter(self._entries.items()))
+            if self.is_pinned is not None and self.is_pinned(topic):
+                self._entries.move_to_end(topic)
+                continue
+            del self._entries[topic]
+            self.size_bytes -= entry.size
+            self.evictions += 1
+
+    def get_entry(self, topic):
+        with self._lock:
+            entry = self._entries.get(topic)
+            if entry is None:
+                return None
+
+            if self._ttls:
+                ttl = self.ttl_for(topic)
+                if ttl is not None and time.time() - entry.ts > ttl:
+                    del self._entries[topic]
+                    self.size_bytes -= entry.size
+                    self.expirations += 1
+                    return None
+
+            self._entries.move_to_end(topic)
+            return entry
+
+    def get(self, topic, default=None):
+        entry = self.get_entry(topic)
+        return default if entry is None else entry.payload
+
+    def pop(self, topic, default=None):
+        with self._lock:
+            entry = self._entries.pop(topic, None)
+            if entry is None:
+                return default
+            self.size_bytes -= entry.size
+            return entry.payload
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def __contains__(self, topic):
+        return self.get_entry(topic) is not None
+
+    def __getitem__(self, topic):
+        entry = self.get_entry(topic)
+        if entry is None:
+            raise KeyError(topic)
+        return entry.payload
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# ---------------------------------------------------------
+# Handler dispatch off the network thread
+# ---------------------------------------------------------
+
+class Dispatcher:
+    """Pool of worker threads that run message handlers.
+
+    Every key (topic) is always served by the same worker, so messages for
+    one topic are handled in the order they arrived while different topics
+    run in parallel.
+    """
+
+    def __init__(self, workers=4, name="dataspace-dispatch"):
+        self._queues = [queue.SimpleQueue() for _ in range(workers)]
+        self._threads = []
+        self._closed = False
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.completed = 0
+        self.max_depth = 0
+
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(target=self._run, args=(q,), name=f"{name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, fn, *args):
+        if self._closed:
+            raise RuntimeError("Dispatcher is closed")
+        q = self._queues[hash(key) % len(self._queues)]
+        q.put((fn, args))
+        self.submitted += 1
+        depth = q.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            fn, args = item
+            try:
+                fn(*args)
+            except:
+                traceback.print_exc()
+            with self._lock:
+                self.completed += 1
+
+    def close(self, wait=True, timeout=None):
+        """Stop the workers once the already queued messages are handled."""
+        if self._closed:
+            return
+        self._closed = True
+        for q in self._queues:
+            q.put(None)
+        if wait:
+            for t in self._threads:
+                if t is not threading.current_thread():
+                    t.join(timeout)
+
+    def stats(self):
+        depths = [q.qsize() for q in self._queues]
+        return {
+            "workers": len(self._queues),
+            "queue_depths": depths,
+            "queued": sum(depths),
+            "max_depth": self.max_depth,
+            "submitted": self.submitted,
+            "completed": self.completed,
+        }
+
+
+# ---------------------------------------------------------
+# Subscription registry
+# ---------------------------------------------------------
+
+_subscription_ids = itertools.count(1)
+
+
+class Subscription:
+    __slots__ = ("id", "topic", "handler", "jsonpath", "refcount", "as_message")
+
+    def __init__(self, topic, handler, jsonpath):
+        self.id = next(_subscription_ids)
+        self.topic = topic
+        self.handler = handler
+        self.jsonpath = jsonpath
+        self.refcount = 1
+        self.as_message = wants_message(handler)
+
+
+class SubscriptionRegistry:
+    """Subscriptions per topic filter with refcounts and stable ids.
+
+    Adding and removing are O(1). get() returns an immutable tuple of
+    (handler, jsonpath, as_message) that is rebuilt lazily after a change, so dispatch
+    can iterate it without a lock while others subscribe or unsubscribe.
+    Compound updates hold .lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._by_topic = {}    # topic → {(handler, jsonpath): Subscription}
+        self._by_id = {}       # id → Subscription
+        self._snapshots = {}   # topic → ((handler, jsonpath, as_message), ...)
+
+    def add(self, topic, handler, jsonpath=None):
+        """Returns (subscription, new_topic, new_entry)."""
+        key = (handler, jsonpath)
+        with self.lock:
+            entries = self._by_topic.get(topic)
+            new_topic = entries is None
+            if new_topic:
+                entries = self._by_topic[topic] = {}
+
+            sub = entries.get(key)
+            if sub is not None:
+                sub.refcount += 1
+                return sub, False, False
+
+            sub = entries[key] = Subscription(topic, handler, jsonpath)
+            self._by_id[sub.id] = sub
+            self._snapshots.pop(topic, None)
+            return sub, new_topic, True
+
+    def remove(self, topic, handler, jsonpath=None):
+        """Drop one reference. Returns (removed_entry, topic_now_empty)."""
+        with self.lock:
+            entries = self._by_topic.get(topic)
+            if not entries:
+                return False, False
+            sub = entries.get((handler, jsonpath))
+            if sub is None:
+                return False, False
+
+            sub.refcount -= 1
+            if sub.refcount > 0:
+                return False, False
+
+            del entries[(handler, jsonpath)]
+            del self._by_id[sub.id]
+            self._snapshots.pop(topic, None)
+            if not entries:
+                del self._by_topic[topic]
+                return True, True
+            return True, False
+
+    def by_id(self, sub_id):
+        return self._by_id.get(sub_id)
+
+    def get(self, topic, default=()):
+        snapshot = self._snapshots.get(topic)
+        if snapshot is not None:
+            return snapshot
+        with self.lock:
+            entries = self._by_topic.get(topic)
+            if entries is None:
+                return default
+            snapshot = self._snapshots[topic] = tuple(
+                (handler, jsonpath, sub.as_message) for (handler, jsonpath), sub in entries.items())
+            return snapshot
+
+    def __getitem__(self, topic):
+        if topic not in self._by_topic:
+            raise KeyError(topic)
+        return self.get(topic)
+
+    def __contains__(self, topic):
+        return topic in self._by_topic
+
+    def __len__(self):
+        return len(self._by_topic)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        with self.lock:
+            return list(self._by_topic.keys())
+
+    def refcount(self, topic, handler, jsonpath=None):
+        sub = self._by_topic.get(topic, {}).get((handler, jsonpath))
+        return 0 if sub is None else sub.refcount
+
+
+class AckTracker:
+    """Future that resolves when SUBACK/UNSUBACK has arrived for every topic filter.
+
+    The result is {topic filter: reason code}. Reason codes with
+    is_failure set mean the server refused the filter.
+    """
+
+    def __init__(self, topics, hidden=()):
+        self.future = concurrent.futures.Future()
+        self.waiting = set(topics) | set(hidden)
+        self.hidden = set(hidden)   # waited for but not part of the result
+        self.codes = {}
+        if not self.waiting:
+            self.future.set_result({})
+
+    def ack(self, topic, code):
+        """Record one acknowledgement, True when nothing is left to wait for."""
+        if topic in self.waiting:
+            self.waiting.discard(topic)
+            if topic not in self.hidden:
+                self.codes[topic] = code
+        return not self.waiting
+
+    def finish(self):
+        if not self.future.done():
+            self.future.set_result(self.codes)
+
+
+# ---------------------------------------------------------
+# Queued publishing
+# ---------------------------------------------------------
+
+def encode_payload(payload):
+    """Payloads that are not str/bytes are sent as JSON, like Broker.Publish does."""
+    if not isinstance(payload, (str, bytes, bytearray)):
+        payload = json.dumps(payload).encode("utf-8")
+    return payload
+
+
+class QueuedPublisher:
+    """Background thread that feeds paho from a byte-bounded queue.
+
+    publish() blocks (backpressure) while more than max_queue_bytes are
+    waiting. The worker hands messages to paho in batches and stops while
+    max_pending messages are still waiting for on_publish, so paho's own
+    queue stays bounded too. max_inflight should match paho's QoS>0
+    in-flight window (Broker's max_inflight), paho refuses to change it
+    once connected and a warning is given if they differ.
+    """
+
+    def __init__(self, client, max_queue_bytes=64 * 1024 * 1024, max_inflight=100,
+                 max_pending=None, batch_size=500, connected=None):
+        self.client = client
+        self.connected = connected   # Event, batches wait for it before going to paho
+        self.max_queue_bytes = max_queue_bytes
+        self.max_inflight = max_inflight
+        self.max_pending = max_pending or max_inflight * 10
+        self.batch_size = batch_size
+
+        # paho only allows these before connecting, Broker sets them then
+        # (paho's own queue unlimited, the byte budget above bounds it)
+        if getattr(client, "max_queued_messages", 0) != 0:
+            try:
+                client.max_queued_messages_set(0)
+            except RuntimeError:
+                warnings.warn("paho's message queue limit can only be changed before connecting",
+                              RuntimeWarning, stacklevel=3)
+        if getattr(client, "max_inflight_messages", max_inflight) != max_inflight:
+            try:
+                client.max_inflight_messages_set(max_inflight)
+            except RuntimeError:
+                warnings.warn(f"In-flight window stays at {client.max_inflight_messages}, "
+                              f"pass max_inflight to Broker (or set DataHub.max_inflight) "
+                              f"to change it before connecting", RuntimeWarning, stacklevel=3)
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._queued_bytes = 0
+        self._unacked = set()      # mids handed to paho and not yet published
+        self._early_acks = set()   # on_publish while a message was being handed to paho
+        self._sending = False      # between client.publish() and recording its mid
+        self._closed = False
+
+        self.started = time.time()
+        self.enqueued = 0
+        self.published = 0
+        self.published_bytes = 0
+        self.failed = 0
+        self.blocked_seconds = 0.0
+
+        self._thread = threading.Thread(target=self._run, name="dataspace-publisher", daemon=True)
+        self._thread.start()
+
+    def publish(self, topic, payload, qos=0, retain=False, properties=None, timeout=None):
+        """Queue one message, returns False if the queue stayed full for timeout seconds."""
+        size = len(payload) + len(topic)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Publisher is closed")
+
+            if self._queued_bytes + size > self.max_queue_bytes and self._queue:
+                started = time.time()
+                ok = self._cond.wait_for(
+                    lambda: self._closed or not self._queue or
+                    self._queued_bytes + size <= self.max_queue_bytes,
+                    timeout)
+                self.blocked_seconds += time.time() - started
+                if not ok:
+                    return False
+
+            self._queue.append((topic, payload, qos, retain, properties, size))
+            self._queued_bytes += size
+            self.enqueued += 1
+            self._cond.notify_all()
+        return True
+
+    def on_publish(self, mid):
+        with self._cond:
+            if mid in self._unacked:
+                self._unacked.discard(mid)
+                self._cond.notify_all()
+            elif self._sending:
+                # Possibly ours, acknowledged before publish() returned. Other
+                # mids (direct Publish, chunks) are ignored, paho reuses them.
+                self._early_acks.add(mid)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: (self._queue and len(self._unacked) < self.max_pending)
+                                    or (self._closed and not self._queue))
+                if not self._queue:
+                    return
+                room = max(self.max_pending - len(self._unacked), 1)
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, room, len(self._queue)))]
+                self._queued_bytes -= sum(item[5] for item in batch)
+                self._cond.notify_all()
+
+            # Not connected yet, paho would drop QoS 0 messages
+            if self.connected is not None:
+                while not self.connected.wait(0.5) and not self._closed:
+                    pass
+
+            for topic, payload, qos, retain, properties, size in batch:
+                with self._cond:
+                    self._sending = True
+                try:
+                    info = self.client.publish(topic, payload, qos, retain, properties)
+                except Exception:
+                    traceback.print_exc()
+                    info = None
+
+                with self._cond:
+                    self._sending = False
+                    early_acks = self._early_acks
+                    self._early_acks = set()
+                    if info is None or (info.rc != mqtt.MQTT_ERR_SUCCESS and qos == 0):
+                        # Not sent and never acknowledged
+                        self.failed += 1
+                        continue
+                    self.published += 1
+                    self.published_bytes += size
+                    if info.mid not in early_acks:
+                        self._unacked.add(info.mid)
+
+    def flush(self, timeout=None):
+        """Wait until everything queued has been handed over and acknowledged by paho."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not self._unacked, timeout)
+
+    def close(self, flush=True, timeout=10):
+        if flush:
+            self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            elapsed = max(time.time() - self.started, 1e-9)
+            return {
+                "queued": len(self._queue),
+                "queued_bytes": self._queued_bytes,
+                "max_queue_bytes": self.max_queue_bytes,
+                "unacked": len(self._unacked),
+                "enqueued": self.enqueued,
+                "published": self.published,
+                "published_bytes": self.published_bytes,
+                "failed": self.failed,
+                "messages_per_second": self.published / elapsed,
+                "bytes_per_second": self.published_bytes / elapsed,
+                "blocked_seconds": self.blocked_seconds,
+            }
+
+
+# ---------------------------------------------------------
+# Last-value-wins publish coalescing
+# ---------------------------------------------------------
+
+class _CoalesceState:
+    __slots__ = ("rate", "burst", "tokens", "refilled", "pending", "scheduled")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.refilled = now
+        self.pending = None     # (payload, qos, retain, properties)
+        self.scheduled = False
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+
+class PublishCoalescer:
+    """Rate limits publishing per topic with a token bucket.
+
+    A publish that finds no token is kept as the topic's pending value and
+    overwritten by newer publishes, so only the newest value goes out when
+    the next token is available. close() sends everything still pending.
+    """
+
+    def __init__(self, send):
+        self.send = send
+        self._rules = {}     # topic or prefix → (rate, burst)
+        self._states = {}    # topic → _CoalesceState
+        self._heap = []      # (due, topic)
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self.sent = 0
+        self.coalesced = 0
+
+        self._thread = threading.Thread(target=self._run, name="dataspace-coalescer", daemon=True)
+        self._thread.start()
+
+    def set_rate(self, topic_or_prefix, rate=None, burst=1):
+        """rate messages per second per topic under topic_or_prefix, None removes the rule."""
+        with self._cond:
+            if rate is None:
+                self._rules.pop(topic_or_prefix, None)
+            else:
+                self._rules[topic_or_prefix] = (rate, burst)
+
+    def rule_for(self, topic):
+        # The longest matching prefix wins
+        best = None
+        best_len = -1
+        for prefix, rule in self._rules.items():
+            if len(prefix) > best_len and topic.startswith(prefix):
+                best, best_len = rule, len(prefix)
+        return best
+
+    def publish(self, topic, payload, qos=0, retain=False, properties=None):
+        """Returns False if no rule applies and the caller should publish directly."""
+        if not self._rules:
+            return False
+
+        with self._cond:
+            rule = self.rule_for(topic)
+            if rule is None or self._closed:
+                return False
+
+            now = time.monotonic()
+            state = self._states.get(topic)
+            if state is None:
+                state = self._states[topic] = _CoalesceState(rule[0], rule[1], now)
+            else:
+                state.refill(now)
+
+            send_now = state.pending is None and state.tokens >= 1
+            if send_now:
+                state.tokens -= 1
+            else:
+                if state.pending is not None:
+                    self.coalesced += 1
+                state.pending = (payload, qos, retain, properties)
+                if not state.scheduled:
+                    state.scheduled = True
+                    due = now + (1 - state.tokens) / state.rate
+                    heapq.heappush(self._heap, (due, topic))
+                    self._cond.notify()
+
+        if send_now:
+            self.send(topic, payload, qos, retain, properties)
+            self.sent += 1
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._heap:
+                        delay = self._heap[0][0] - time.monotonic()
+                        if delay <= 0:
+                            break
+                        self._cond.wait(delay)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+
+                _, topic = heapq.heappop(self._heap)
+                state = self._states[topic]
+                now = time.monotonic()
+                state.refill(now)
+                message = None
+                if state.tokens >= 1:
+                    state.tokens -= 1
+                    message, state.pending, state.scheduled = state.pending, None, False
+                else:
+                    heapq.heappush(self._heap, (now + (1 - state.tokens) / state.rate, topic))
+
+                if len(self._states) > 10000:
+                    self._prune(now)
+
+            if message is not None:
+                self._send(topic, message)
+
+    def _prune(self, now):
+        # Called with the lock held, idle topics with full buckets carry no state
+        for topic in [t for t, st in self._states.items() if not st.scheduled]:
+            state = self._states[topic]
+            state.refill(now)
+            if state.tokens >= state.burst:
+                del self._states[topic]
+
+    def _send(self, topic, message):
+        payload, qos, retain, properties = message
+        try:
+            result = self.send(topic, payload, qos, retain, properties)
+            self.sent += 1
+            return result
+        except Exception:
+            traceback.print_exc()
+
+    def flush(self):
+        """Send all pending values now, ignoring the rate. Returns what send returned for each."""
+        with self._cond:
+            pending = []
+            for topic, state in self._states.items():
+                if state.pending is not None:
+                    pending.append((topic, state.pending))
+                    state.pending = None
+                    state.scheduled = False
+            self._heap.clear()
+        return [self._send(topic, message) for topic, message in pending]
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "rules": len(self._rules),
+                "topics": len(self._states),
+                "pending": sum(1 for st in self._states.values() if st.pending is not None),
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+            }
+
+
+# ---------------------------------------------------------
+# JSON merge patch (RFC 7396) for partial document updates
+# ---------------------------------------------------------
+
+MERGE_PATCH_CONTENT_TYPE = "application/merge-patch+json"
+
+
+def payload_digest(payload):
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+
+def _has_null_member(value):
+    # Null members of objects would be read as deletions by apply_merge_patch
+    if isinstance(value, dict):
+        return any(v is None or _has_null_member(v) for v in value.values())
+    return False
+
+
+def make_merge_patch(old, new):
+    """Return the merge patch turning old into new.
+
+    Raises ValueError if the change cannot be expressed as a merge patch
+    (non-object documents or new null values).
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        raise ValueError("merge patch needs JSON objects")
+
+    patch = {}
+    for key, value in new.items():
+        if key in old:
+            old_value = old[key]
+            if old_value == value:
+                continue
+            if isinstance(old_value, dict) and isinstance(value, dict):
+                patch[key] = make_merge_patch(old_value, value)
+                continue
+        if value is None or _has_null_member(value):
+            raise ValueError("null values cannot be sent in a merge patch")
+        patch[key] = value
+
+    for key in old:
+        if key not in new:
+            patch[key] = None
+    return patch
+
+
+def apply_merge_patch(target, patch):
+    """Apply a merge patch as described in RFC 7396, returns the result."""
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = apply_merge_patch(target.get(key), value)
+    return target
+
+
+def user_properties(properties):
+    """MQTT v5 user properties as a dict (empty if there are none)."""
+    if properties is None:
+        return {}
+    return dict(getattr(properties, "UserProperty", None) or ())
+
+
+# ---------------------------------------------------------
+# Payload compression (MQTT v5 user property)
+# ---------------------------------------------------------
+
+CONTENT_ENCODING_PROPERTY = "dataspace-encoding"
+
+
+def _zstd():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        raise ValueError("zstd compression needs the zstandard package (pip install dataspace-client[zstd])")
+
+
+def compress_payload(payload, encoding, level=None):
+    if encoding == "zlib":
+        return zlib.compress(payload, 6 if level is None else level)
+    if encoding == "zstd":
+        return _zstd().ZstdCompressor(level=3 if level is None else level).compress(payload)
+    raise ValueError(f"Unknown content encoding: {encoding}")
+
+
+def decompress_payload(payload, encoding):
+    if encoding == "zlib":
+        return zlib.decompress(payload)
+    if encoding == "zstd":
+        # Frames written by ZstdCompressor.compress always carry the content size
+        return _zstd().ZstdDecompressor().decompress(payload)
+    raise ValueError(f"Unknown content encoding: {encoding}")
+
+
+class PayloadCompressor:
+    """Compresses outgoing payloads and decompresses incoming ones.
+
+    Payloads of at least threshold bytes are compressed with encoding
+    ("zlib" or "zstd") and tagged with the dataspace-encoding user property.
+    Payloads that do not get smaller are sent as they are. encoding=None
+    only decompresses. Per-topic byte counts and CPU time are kept for stats().
+    """
+
+    def __init__(self, encoding=None, threshold=1024, level=None):
+        self.encoding = encoding
+        self.threshold = threshold
+        self.level = level
+        self._lock = threading.Lock()
+        self._stats = {}   # topic → counters
+
+    def _topic_stats(self, topic):
+        stats = self._stats.get(topic)
+        if stats is None:
+            stats = self._stats[topic] = {
+                "compressed": 0, "not_smaller": 0, "bytes_in": 0, "bytes_out": 0, "compress_seconds": 0.0,
+                "decompressed": 0, "bytes_received": 0, "bytes_decoded": 0, "decompress_seconds": 0.0,
+            }
+        return stats
+
+    def compress(self, topic, payload, properties=None):
+        """Returns (payload, properties) to publish."""
+        if self.encoding is None or len(payload) < self.threshold:
+            return payload, properties
+
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+
+        started = time.process_time()
+        compressed = compress_payload(payload, self.encoding, self.level)
+        elapsed = time.process_time() - started
+
+        with self._lock:
+            stats = self._topic_stats(topic)
+            stats["compress_seconds"] += elapsed
+            if len(compressed) >= len(payload):
+                # Already compressed data such as JPG or GLB
+                stats["not_smaller"] += 1
+                return payload, properties
+            stats["compressed"] += 1
+            stats["bytes_in"] += len(payload)
+            stats["bytes_out"] += len(compressed)
+
+        # Never change the caller's properties
+        properties = copy.copy(properties) if properties is not None else Properties(PacketTypes.PUBLISH)
+        properties.UserProperty = [(CONTENT_ENCODING_PROPERTY, self.encoding)]
+        return compressed, properties
+
+    def decompress(self, topic, payload, properties):
+        """The original payload if the message is compressed, otherwise payload as it is."""
+        encoding = user_properties(properties).get(CONTENT_ENCODING_PROPERTY)
+        if encoding is None:
+            return payload
+
+        started = time.process_time()
+        data = decompress_payload(payload, encoding)
+        elapsed = time.process_time() - started
+
+        with self._lock:
+            stats = self._topic_stats(topic)
+            stats["decompressed"] += 1
+            stats["bytes_received"] += len(payload)
+            stats["bytes_decoded"] += len(data)
+            stats["decompress_seconds"] += elapsed
+        return data
+
+    def stats(self, topic=None):
+        """Counters per topic (or for one topic) including compression ratios."""
+        with self._lock:
+            topics = {topic: self._stats.get(topic)} if topic is not None else dict(self._stats)
+            result = {}
+            for name, stats in topics.items():
+                if stats is None:
+                    continue
+                stats = dict(stats)
+                stats["ratio_sent"] = stats["bytes_in"] / stats["bytes_out"] if stats["bytes_out"] else None
+                stats["ratio_received"] = (stats["bytes_decoded"] / stats["bytes_received"]
+                                           if stats["bytes_received"] else None)
+                result[name] = stats
+        return result.get(topic) if topic is not None else result
+
+
+# ---------------------------------------------------------
+# Chunked transfer of large payloads
+# ---------------------------------------------------------
+#
+# The sender publishes a manifest (size, chunk size, sha256) to the topic,
+# followed by the chunks, each tagged with "<transfer>:<index>". Receivers
+# reassemble into a preallocated buffer and deliver the payload once it is
+# complete and the hash matches. A receiver that reconnects in the middle of
+# a transfer asks for its missing chunks on the manifest's response topic.
+
+CHUNK_MANIFEST_CONTENT_TYPE = "application/vnd.dataspace.chunk-manifest+json"
+CHUNK_CONTENT_TYPE = "application/vnd.dataspace.chunk"
+CHUNK_REQUEST_CONTENT_TYPE = "application/vnd.dataspace.chunk-request+json"
+CHUNK_PROPERTY = "dataspace-chunk"
+CHUNK_CONTENT_TYPES = (CHUNK_MANIFEST_CONTENT_TYPE, CHUNK_CONTENT_TYPE, CHUNK_REQUEST_CONTENT_TYPE)
+
+
+class OutgoingTransfer:
+    """A payload split into chunks, kept after sending to answer resend requests."""
+
+    def __init__(self, topic, payload, chunk_size, qos, reply_topic, encoding=None):
+        self.id = uuid.uuid4().hex
+        self.topic = topic
+        self.payload = payload
+        self.chunk_size = chunk_size
+        self.qos = qos
+        self.reply_topic = reply_topic
+        self.chunks = max((len(payload) + chunk_size - 1) // chunk_size, 1)
+        self.finished = None
+        self.resent = 0
+
+        manifest = {
+            "transfer": self.id,
+            "size": len(payload),
+            "chunk_size": chunk_size,
+            "chunks": self.chunks,
+            "sha256": payload_digest(payload),
+        }
+        if encoding is not None:
+            manifest["encoding"] = encoding
+        self.manifest = json.dumps(manifest).encode("utf-8")
+
+    def manifest_properties(self):
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.ContentType = CHUNK_MANIFEST_CONTENT_TYPE
+        properties.ResponseTopic = self.reply_topic
+        return properties
+
+    def chunk(self, index):
+        """(data, properties) of one chunk."""
+        start = index * self.chunk_size
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.ContentType = CHUNK_CONTENT_TYPE
+        properties.UserProperty = [(CHUNK_PROPERTY, f"{self.id}:{index}")]
+        return self.payload[start:start + self.chunk_size], properties
+
+
+class IncomingTransfer:
+    """Reassembly state of one transfer, chunks may arrive in any order and more than once.
+
+    Chunks are written into a temporary file (kept in memory up to
+    spool_bytes), so the finished payload is read back as one immutable
+    bytes object without holding a second copy of it.
+    """
+
+    spool_bytes = 8 * 1024 * 1024
+
+    def __init__(self, topic, manifest, reply_topic=None, msg_type=None):
+        self.id = manifest["transfer"]
+        self.topic = topic
+        self.size = int(manifest["size"])
+        self.chunk_size = int(manifest["chunk_size"])
+        self.chunks = int(manifest["chunks"])
+        self.digest = manifest["sha256"]
+        self.encoding = manifest.get("encoding")
+        self.reply_topic = reply_topic
+        self.msg_type = msg_type
+
+        if self.chunk_size <= 0 or self.chunks != max((self.size + self.chunk_size - 1) // self.chunk_size, 1):
+            raise ValueError("Inconsistent chunk manifest")
+
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        self.received = bytearray(self.chunks)   # 1 for each chunk we have
+        self.received_count = 0
+        self.received_bytes = 0
+        self.updated = time.time()
+
+    def add(self, index, data):
+        """Copy a chunk into place, False for duplicates and chunks that do not fit."""
+        if not 0 <= index < self.chunks or self.received[index]:
+            return False
+        start = index * self.chunk_size
+        if len(data) != min(self.chunk_size, self.size - start):
+            return False
+        self.buffer.seek(start)
+        self.buffer.write(data)
+        self.received[index] = 1
+        self.received_count += 1
+        self.received_bytes += len(data)
+        self.updated = time.time()
+        return True
+
+    @property
+    def complete(self):
+        return self.received_count == self.chunks
+
+    def missing(self):
+        return [i for i, have in enumerate(self.received) if not have]
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+
+    def result(self):
+        """The reassembled payload as bytes, raises ValueError if the hash does not match."""
+        self.buffer.seek(0)
+        payload = self.buffer.read(self.size)
+        self.close()
+        if payload_digest(payload) != self.digest:
+            raise ValueError(f"Chunked transfer {self.id} to {self.topic} failed the hash check")
+        if self.encoding is not None:
+            payload = decompress_payload(payload, self.encoding)
+        return payload
+
+
+# ---------------------------------------------------------
+# Persistent on-disk cache (warm starts)
+# ---------------------------------------------------------
+
+class PersistentCache:
+    """Last payload per server/topic kept on disk between processes.
+
+    The index (timestamp, message type, digest) lives in SQLite. Payloads
+    larger than inline_bytes are stored as content-addressed blob files,
+    smaller ones inline in the index. Writes are queued and done by a
+    background thread, newer writes for the same topic replace queued ones.
+    get() only returns entries at most max_age seconds old (None = any age).
+    Every prune_interval seconds the writer deletes entries older than
+    max_age and the oldest ones beyond max_entries, with their blob files.
+    """
+
+    def __init__(self, path=None, max_age=7 * 24 * 3600, inline_bytes=16 * 1024,
+                 max_entries=100_000, prune_interval=600):
+        self.path = path or os.path.join(os.path.expanduser("~"), ".dataspace", "cache")
+        self.blob_path = os.path.join(self.path, "blobs")
+        self.max_age = max_age
+        self.inline_bytes = inline_bytes
+        self.max_entries = max_entries
+        self.prune_interval = prune_interval
+        os.makedirs(self.blob_path, exist_ok=True)
+
+        self._db = sqlite3.connect(os.path.join(self.path, "index.sqlite"), check_same_thread=False)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " server TEXT, topic TEXT, ts REAL, msg_type INTEGER,"
+                " digest TEXT, data BLOB, PRIMARY KEY (server, topic))")
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)")
+
+        self._pending = OrderedDict()   # (server, topic) → (payload, ts, msg_type)
+        self._writing = {}              # batch the writer is storing, still served by get()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.written = 0
+        self.pruned = 0
+
+        self._thread = threading.Thread(target=self._run, name="dataspace-persist", daemon=True)
+        self._thread.start()
+
+    def _blob_file(self, digest):
+        return os.path.join(self.blob_path, digest[:2], digest)
+
+    def put(self, server, topic, payload, ts, msg_type: message_type):
+        """Queue a write, returns immediately."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif not isinstance(payload, (bytes, bytearray)):
+            return
+        with self._cond:
+            if self._closed:
+                return
+            key = (server, topic)
+            self._pending.pop(key, None)
+            self._pending[key] = (payload, ts, msg_type)
+            self._cond.notify()
+
+    def get(self, server, topic, max_age=None):
+        """Returns (payload, ts, msg_type) or None if missing or too old."""
+        max_age = self.max_age if max_age is None else max_age
+
+        with self._cond:
+            queued = self._pending.get((server, topic)) or self._writing.get((server, topic))
+        if queued is not None:
+            payload, ts, msg_type = queued
+        else:
+            with self._db_lock:
+                row = self._db.execute(
+                    "SELECT ts, msg_type, digest, data FROM entries WHERE server=? AND topic=?",
+                    (server, topic)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            ts, msg_type_value, digest, payload = row
+            msg_type = message_type(msg_type_value)
+
+        if max_age is not None and time.time() - ts > max_age:
+            self.stale += 1
+            return None
+
+        if payload is None:
+            try:
+                with open(self._blob_file(digest), "rb") as f:
+                    payload = f.read()
+            except OSError:
+                self.misses += 1
+                return None
+
+        self.hits += 1
+        return bytes(payload), ts, msg_type
+
+    def _run(self):
+        next_prune = time.monotonic()
+        while True:
+            if time.monotonic() >= next_prune:
+                try:
+                    self._prune()
+                except Exception:
+                    traceback.print_exc()
+                next_prune = time.monotonic() + self.prune_interval
+
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closed,
+                                    max(next_prune - time.monotonic(), 0))
+                if not self._pending:
+                    if self._closed:
+                        return
+                    continue
+                self._writing = self._pending
+                self._pending = OrderedDict()
+            try:
+                self._write(list(self._writing.items()))
+            except Exception:
+                traceback.print_exc()
+            with self._cond:
+                self._writing = {}
+                self._cond.notify_all()
+
+    def _write(self, batch):
+        rows = []
+        for (server, topic), (payload, ts, msg_type) in batch:
+            digest = payload_digest(payload)
+            data = None
+            if len(payload) > self.inline_bytes:
+                blob = self._blob_file(digest)
+                if not os.path.exists(blob):
+                    os.makedirs(os.path.dirname(blob), exist_ok=True)
+                    tmp = f"{blob}.{uuid.uuid4().hex}.tmp"
+                    with open(tmp, "wb") as f:
+                        f.write(payload)
+                    os.replace(tmp, blob)
+            else:
+                data = bytes(payload)
+            rows.append((server, topic, ts, msg_type.value, digest, data))
+
+        with self._db_lock, self._db:
+            old_digests = set()
+            for server, topic, *_ in rows:
+                row = self._db.execute("SELECT digest, data FROM entries WHERE server=? AND topic=?",
+                                       (server, topic)).fetchone()
+                if row is not None and row[1] is None:
+                    old_digests.add(row[0])
+            self._db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._remove_unreferenced_blobs(old_digests)
+        self.written += len(rows)
+
+    def _remove_unreferenced_blobs(self, digests):
+        # Called with _db_lock held
+        for digest in digests:
+            if self._db.execute("SELECT 1 FROM entries WHERE digest=? AND data IS NULL LIMIT 1",
+                                (digest,)).fetchone() is None:
+                try:
+                    os.remove(self._blob_file(digest))
+                except OSError:
+                    pass
+
+    def _prune(self):
+        """Delete entries older than max_age and the oldest beyond max_entries."""
+        cutoff = -1.0 if self.max_age is None else time.time() - self.max_age
+        with self._db_lock, self._db:
+            doomed = self._db.execute(
+                "SELECT server, topic, digest, data IS NULL FROM entries WHERE ts < ?", (cutoff,)).fetchall()
+            excess = 0
+            if self.max_entries is not None:
+                kept = self._db.execute("SELECT COUNT(*) FROM entries WHERE ts >= ?", (cutoff,)).fetchone()[0]
+                excess = kept - self.max_entries
+            if excess > 0:
+                doomed += self._db.execute(
+                    "SELECT server, topic, digest, data IS NULL FROM entries WHERE ts >= ? ORDER BY ts LIMIT ?",
+                    (cutoff, excess)).fetchall()
+            if not doomed:
+                return
+            self._db.executemany("DELETE FROM entries WHERE server=? AND topic=?",
+                                 [(server, topic) for server, topic, _, _ in doomed])
+            self._remove_unreferenced_blobs({digest for _, _, digest, is_blob in doomed if is_blob})
+        self.pruned += len(doomed)
+
+    def flush(self, timeout=None):
+        """Wait until every queued write is on disk."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._writing, timeout)
+
+    def close(self, timeout=10):
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        with self._db_lock:
+            self._db.close()
+
+    def stats(self):
+        with self._cond:
+            queued = len(self._pending)
+        return {"hits": self.hits, "misses": self.misses, "stale": self.stale,
+                "written": self.written, "pruned": self.pruned, "queued": queued}
+
+
+def _try_lock(f):
+    """Non-blocking exclusive lock on an open file, released when it is closed."""
+    try:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def lease_client_id(user, broker, port, path=None):
+    """Client id for a persistent session that stays the same between runs on this machine.
+
+    Ids are stored per user, server, host and program in numbered slot files
+    under path (~/.dataspace/sessions). A running client holds a lock on its
+    slot, so two processes of the same program (Jupyter kernels, Excel
+    instances) never share an id; the second one takes the next slot.
+    Returns (client_id, lock_file), close lock_file to release the slot.
+    """
+    path = path or os.path.join(os.path.expanduser("~"), ".dataspace", "sessions")
+    os.makedirs(path, exist_ok=True)
+    program = os.path.abspath(sys.argv[0]) if sys.argv and sys.argv[0] else ""
+    key = uuid.uuid5(uuid.NAMESPACE_URL, f"{user}@{broker}:{port}/{socket.gethostname()}/{program}")
+
+    for slot in itertools.count():
+        f = open(os.path.join(path, f"{key}-{slot}"), "a+")
+        if not _try_lock(f):
+            f.close()
+            continue
+        f.seek(0)
+        client_id = f.read().strip()
+        if not client_id:
+            client_id = f"client-{uuid.uuid4()}"
+            f.write(client_id)
+            f.flush()
+        return client_id, f
+
+
+# Markers used when a payload is decoded once and shared between handlers
+NOT_DECODED = object()
+NOT_JSON = object()
+
+
+# ---------------------------------------------------------
+# Payload kinds and lazily decoded views
+# ---------------------------------------------------------
+
+BINARY_KINDS = ("jpeg", "png", "glb", "gzip", "zip")
+
+
+class PayloadDecoders:
+    """Registry deciding what kind of data a payload is.
+
+    Looks at the MQTT v5 content type first, then the payload format
+    indicator, then the topic extension and last the leading magic bytes.
+    Each kind can have a decoder used by PayloadView.value.
+    """
+
+    def __init__(self):
+        self.content_types = {}   # "application/json" → kind
+        self.extensions = {}      # ".json" → kind, "/" for directory listings
+        self.magic = []           # [(prefix, kind)], longest prefix first
+        self.decoders = {}        # kind → callable(bytes)
+
+    def register(self, kind, decoder=None, content_types=(), extensions=(), magic=()):
+        for content_type in content_types:
+            self.content_types[content_type.lower()] = kind
+        for extension in extensions:
+            self.extensions[extension.lower()] = kind
+        if magic:
+            self.magic.extend((prefix, kind) for prefix in magic)
+            self.magic.sort(key=lambda item: -len(item[0]))
+        if decoder is not None:
+            self.decoders[kind] = decoder
+
+    def kind(self, topic, payload, properties=None):
+        """The kind of payload, None if nothing matched."""
+        content_type = getattr(properties, "ContentType", None)
+        if content_type:
+            kind = self.content_types.get(content_type.split(";", 1)[0].strip().lower())
+            if kind is not None:
+                return kind
+        if getattr(properties, "PayloadFormatIndicator", 0) == 1:
+            return "text"
+
+        if topic:
+            topic = topic.split("$", 1)[0]
+            if topic.endswith("/"):
+                kind = self.extensions.get("/")
+            else:
+                kind = self.extensions.get(os.path.splitext(topic.rsplit("/", 1)[-1])[1].lower())
+            if kind is not None:
+                return kind
+
+        if isinstance(payload, (bytes, bytearray, memoryview)) and self.magic:
+            head = bytes(payload[:16])
+            for prefix, kind in self.magic:
+                if head.startswith(prefix):
+                    return kind
+        return None
+
+    def decode(self, kind, payload):
+        decoder = self.decoders.get(kind)
+        return payload if decoder is None else decoder(payload)
+
+
+payload_decoders = PayloadDecoders()
+payload_decoders.register("json", json.loads, content_types=("application/json", "text/json"),
+                          extensions=(".json", ".geojson", "/"))
+payload_decoders.register("text", lambda data: data.decode("utf-8"),
+                          content_types=("text/plain", "text/csv", "application/x-ndjson"),
+                          extensions=(".txt", ".csv", ".log", ".jsonl", ".md"))
+payload_decoders.register("jpeg", content_types=("image/jpeg",), extensions=(".jpg", ".jpeg"), magic=(JPEG_MAGIC,))
+payload_decoders.register("png", content_types=("image/png",), extensions=(".png",), magic=(b"\x89PNG\r\n\x1a\n",))
+payload_decoders.register("glb", content_types=("model/gltf-binary",), extensions=(".glb",), magic=(b"glTF",))
+payload_decoders.register("gzip", content_types=("application/gzip",), extensions=(".gz",), magic=(b"\x1f\x8b",))
+payload_decoders.register("zip", content_types=("application/zip",), extensions=(".zip",), magic=(b"PK\x03\x04",))
+
+
+class PayloadView:
+    """One payload with lazily decoded, memoized views.
+
+    The first access of .json or .text decodes, later accesses (for example
+    from other handlers of the same message) reuse the result. Payloads of
+    a known binary kind are never parsed as JSON or text.
+    """
+
+    __slots__ = ("topic", "raw", "properties", "decoders", "_kind", "_text", "_json")
+
+    def __init__(self, topic, raw, properties=None, decoders=None):
+        self.topic = topic
+        self.raw = raw
+        self.properties = properties
+        self.decoders = decoders or payload_decoders
+        self._kind = NOT_DECODED
+        self._text = NOT_DECODED
+        self._json = NOT_DECODED
+
+    @property
+    def kind(self):
+        if self._kind is NOT_DECODED:
+            self._kind = self.decoders.kind(self.topic, self.raw, self.properties)
+        return self._kind
+
+    @property
+    def bytes(self):
+        raw = self.raw
+        if isinstance(raw, str):
+            return raw.encode("utf-8")
+        if isinstance(raw, (bytes, bytearray, memoryview)):
+            return raw
+        return encode_payload(raw)
+
+    @property
+    def text(self):
+        """The payload as str, None for binary payloads."""
+        if self._text is NOT_DECODED:
+            raw = self.raw
+            if isinstance(raw, str):
+                self._text = raw
+            elif not isinstance(raw, (bytes, bytearray, memoryview)) or self.kind in BINARY_KINDS:
+                self._text = None
+            else:
+                try:
+                    self._text = bytes(raw).decode("utf-8") if isinstance(raw, memoryview) else raw.decode("utf-8")
+                except UnicodeDecodeError:
+                    self._text = None
+        return self._text
+
+    def json_value(self):
+        """Parsed JSON or NOT_JSON, for code that must tell null apart from not JSON."""
+        if self._json is NOT_DECODED:
+            raw = self.raw
+            if not isinstance(raw, (str, bytes, bytearray, memoryview)):
+                self._json = raw   # Already decoded, e.g. a JSONPath result
+            elif self.kind in BINARY_KINDS:
+                self._json = NOT_JSON
+            else:
+                try:
+                    self._json = json.loads(self.text if isinstance(raw, memoryview) else raw)
+                except Exception:
+                    self._json = NOT_JSON
+        return self._json
+
+    @property
+    def is_json(self):
+        return self.json_value() is not NOT_JSON
+
+    @property
+    def json(self):
+        """Parsed JSON, None if the payload is not JSON."""
+        value = self.json_value()
+        return None if value is NOT_JSON else value
+
+    @property
+    def value(self):
+        """The payload decoded according to its kind (parsed JSON, str or bytes)."""
+        kind = self.kind
+        if kind == "json" or (kind is None and self.is_json):
+            return self.json
+        if kind == "text" or (kind is None and self.text is not None):
+            return self.text
+        return self.decoders.decode(kind, self.raw) if kind in self.decoders.decoders else self.raw
+
+
+# ---------------------------------------------------------
+# Message objects for handlers
+# ---------------------------------------------------------
+
+def message_handler(handler):
+    """Decorator: handler is called with one Message instead of (url, payload, msg_type).
+
+        @message_handler
+        def on_temperature(msg):
+            print(msg.topic, msg.json)
+    """
+    handler.dataspace_message = True
+    return handler
+
+
+def wants_message(handler):
+    return getattr(handler, "dataspace_message", False)
+
+
+class Message:
+    """A received message as given to message_handler handlers.
+
+    All handlers of the same message (and JSONPath) get the same object, so
+    treat it as read-only. The url is only built when it is read, and
+    json/text/bytes are decoded once and shared.
+    """
+
+    __slots__ = ("topic", "server", "payload", "msg_type", "received", "properties",
+                 "jsonpath", "_view", "_decoders", "_url")
+
+    def __init__(self, topic, server, payload, msg_type, received=None, properties=None,
+                 jsonpath=None, view=None, decoders=None):
+        self.topic = topic
+        self.server = server
+        self.payload = payload              # JSONPath result if jsonpath is set
+        self.msg_type = msg_type
+        self.received = received
+        self.properties = properties
+        self.jsonpath = jsonpath
+        self._view = view
+        self._decoders = decoders
+        self._url = None
+
+    @property
+    def url(self):
+        if self._url is None:
+            self._url = "mqtt://" + self.server + "/" + self.topic
+        return self._url
+
+    @property
+    def view(self):
+        if self._view is None:
+            self._view = PayloadView(self.topic, self.payload, self.properties, self._decoders)
+        return self._view
+
+    @property
+    def kind(self):
+        return self.view.kind
+
+    @property
+    def json(self):
+        return self.view.json
+
+    @property
+    def text(self):
+        return self.view.text
+
+    @property
+    def bytes(self):
+        return self.view.bytes
+
+    def __repr__(self):
+        return f"Message({self.url!r}, {self.msg_type})"
+
+
+# ---------------------------------------------------------
+# Deadlines on one reaper thread
+# ---------------------------------------------------------
+
+class Deadline:
+    """Handle of a call scheduled with DeadlineScheduler."""
+    __slots__ = ("fn", "args", "cancelled")
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class DeadlineScheduler:
+    """Runs delayed calls (timeouts, flush windows) on one reaper thread.
+
+    Deadlines are kept in a heap, cancelled ones are skipped when they come
+    up and dropped in bulk when they make up most of the heap. Calls should
+    be short, they run one after another on the reaper thread. The thread
+    is started on first use.
+    """
+
+    def __init__(self, name="dataspace-deadlines"):
+        self.name = name
+        self._heap = []      # (due, seq, Deadline)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self.fired = 0
+
+    def schedule(self, delay, fn, *args):
+        """Call fn(*args) after delay seconds, returns a Deadline that can be cancelled."""
+        deadline = Deadline(fn, args)
+        due = time.monotonic() + max(delay, 0)
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._seq), deadline))
+            if self._heap[0][2] is deadline:
+                self._cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            elif len(self._heap) > 1024:
+                self._compact()
+        return deadline
+
+    def _compact(self):
+        # Called with the lock held
+        live = [item for item in self._heap if not item[2].cancelled]
+        if len(live) * 2 < len(self._heap):
+            heapq.heapify(live)
+            self._heap = live
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                _, _, deadline = heapq.heappop(self._heap)
+                deadline.cancelled = True
+                self.fired += 1
+
+            try:
+                deadline.fn(*deadline.args)
+            except Exception:
+                traceback.print_exc()
+
+    def __len__(self):
+        with self._cond:
+            return sum(1 for item in self._heap if not item[2].cancelled)
+
+
+# Timeouts of all brokers share one reaper thread
+deadlines = DeadlineScheduler()
+
+
+class _GetTimeout:
+    """Marker for topics that got no answer before the deadline in GetMany."""
+
+    def __repr__(self):
+        return "GET_TIMEOUT"
+
+    def __bool__(self):
+        return False
+
+
+GET_TIMEOUT = _GetTimeout()
+
+
+class GetFlight:
+    """One outstanding Get request and the number of callers waiting for it."""
+    __slots__ = ("get_obj", "waiters")
+
+    def __init__(self, get_obj):
+        self.get_obj = get_obj
+        self.waiters = 0
+
+
+class LatencyTracker:
+    """Round-trip times of answered Gets, used to pick Get deadlines.
+
+    Keeps an EWMA and the last window samples for the p99. Until
+    min_samples answers have been seen the deadline is the cap.
+    """
+
+    def __init__(self, window=200, alpha=0.2, min_samples=5, floor=0.5):
+        self.samples = deque(maxlen=window)
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.floor = floor
+        self.ewma = None
+        self._p99 = None
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+            self.ewma = seconds if self.ewma is None else self.ewma + self.alpha * (seconds - self.ewma)
+            self._p99 = None
+
+    def p99(self):
+        with self._lock:
+            if self._p99 is None and self.samples:
+                ordered = sorted(self.samples)
+                self._p99 = ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)]
+            return self._p99
+
+    def timeout(self, cap):
+        """Deadline for the next Get: a margin over the slowest recent answers, at most cap."""
+        if len(self.samples) < self.min_samples:
+            return cap
+        return min(max(self.ewma * 4, self.p99() * 2, self.floor), cap)
+
+
 class GetObject():
     def __init__(self, topic, handler=None):
         self.event = threading.Event()
@@ -281,73 +2279,395 @@ class GetObject():
         self.payload = None
         self.handler = handler or self.update
         self.msg_type = None
+        self.timer = None   # Deadline of a non-blocking Get
 
     def update(self, topic, payload, msg_type: message_type):
         self.payload = payload
         self.msg_type = msg_type
         self.event.set()
 
+# Brokers not yet closed, see _flush_at_exit
+_open_brokers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_at_exit():
+    # Rate limited values still waiting (PublishCoalescer) would otherwise be
+    # lost, the Excel and Blender add-ons never call close()
+    for broker in list(_open_brokers):
+        try:
+            broker.flush_publishes(timeout=2)
+        except Exception:
+            traceback.print_exc()
+
+
 class Broker:
-    def __init__(self, broker, port, user, passw, basepath):
+    def __init__(self, broker, port, user, passw, basepath, cache_max_bytes=256 * 1024 * 1024,
+                 dispatch_workers=0, connect=True, persistent_cache=None,
+                 session_expiry=None, client_id=None, max_inflight=100):
 
         print("Connecting as: " + str(user) + "@" + broker + ":" + str(port))
 
-        self.client_id = f'client-{uuid.uuid4()}'
+        # A persistent session (session_expiry seconds) needs the same client id
+        # on every run, otherwise every connect gets a fresh one. The leased id
+        # is locked while this Broker runs, so no other process takes it over.
+        self._client_id_lease = None
+        if client_id is None and session_expiry:
+            client_id, self._client_id_lease = lease_client_id(user, broker, port)
+        self.client_id = client_id or f'client-{uuid.uuid4()}'
+        self.session_expiry = session_expiry
         self.client = mqtt.Client(client_id=self.client_id, protocol=mqtt.MQTTv5)  # Use the latest MQTT version
 
         self.basepath = basepath
         self.default_timezone = pytz.timezone('Europe/Stockholm')
         self.cache = True
-        self.cached = {}
-        self.cached_ts = {}
-        self.cached_msg_type = {}
+        # Last payload per topic, topics with live subscriptions are never evicted
+        self.cached = PayloadCache(max_bytes=cache_max_bytes, is_pinned=self.has_subscribers)
+        self.cached_ts = _CacheFieldView(self.cached, "ts")
+        self.cached_msg_type = _CacheFieldView(self.cached, "msg_type")
+
+        # Optional PersistentCache, answers Get(max_age=...) across restarts (warm start)
+        self.persistent_cache = persistent_cache
 
         self.debug_msg = []
         self.debug = False
         self.lasttopic = ""
 
-        self.subscriptions = {}
-        self.gets = []
+        self.subscriptions = SubscriptionRegistry()
+        self.gets = {}   # topic → {handler: GetObject}
+        self._gets_lock = threading.Lock()
+
+        # Blocking Gets in flight, topic (with JSONPath) → GetFlight shared by all waiters
+        self.get_flights = {}
+        self._flights_lock = threading.Lock()
+        self.get_coalesced = 0
+
+        # Background publisher used by PublishMany, created on first use
+        self.publisher = None
+
+        # Per-topic publish rate limiting, created by set_publish_rate
+        self.coalescer = None
+
+        # Handlers run on the network thread unless a dispatcher is started
+        self.dispatcher = Dispatcher(dispatch_workers) if dispatch_workers > 0 else None
+
+        # Get timeouts and update windows, shared reaper thread by default
+        self.deadlines = deadlines
+
+        # Matches incoming topics against subscribed filters, including + and #
+        self.router = TopicRouter(private_prefix=f"$private/{self.client_id}/")
+
+        # Get(max_age=...) answered from the cache vs. sent to the server
+        self.get_cache_hits = 0
+        self.get_cache_misses = 0
+
+        # Adaptive Get deadlines and topics known to have no value
+        self.get_latency = LatencyTracker()
+        self.get_timeout_cap = 10
+        self.get_answered = 0
+        self.get_timeouts = 0
+        self.get_negative_hits = 0
+        self.missing = {}          # topic → time until which Get answers None at once
+        self.missing_ttl = 5
+
+        # Compiled JSONPath expressions, shared between brokers by default
+        self.jsonpath_cache = jsonpath_cache
+
+        # Decides how payloads are decoded, shared between brokers by default
+        self.payload_decoders = payload_decoders
 
         # An update is an operation that will update a jsonpath as soon as we have full json. 
-        self.pending_updates = {}   # topic_root → [UpdateOperation, ...]
+        self.pending_updates = {}   # topic_root → UpdateOperation
+        self._updates_lock = threading.Lock()
+        self.update_flush_window = 0.05   # seconds to collect updates into one publish
+        self.update_max_age = 10          # cached documents younger than this are used as base
+        self.update_publishes = 0
+
+        # Send JSONPath updates as merge patches instead of full documents.
+        # Incoming patches are always applied to the cached document.
+        self.delta_updates = False
+        self.patch_stats = {"sent": 0, "bytes_sent": 0, "bytes_full": 0, "applied": 0, "skipped": 0}
+
+        # Compressed messages are always decompressed, enable_compression turns on sending them
+        self.compressor = PayloadCompressor()
+
+        # Chunked transfers, see PublishChunked
+        self.chunk_size = 512 * 1024
+        self.chunk_window = 16               # chunks waiting for PUBACK before the sender blocks
+        self.chunk_threshold = None          # Publish sends larger non-retained payloads chunked (off by default)
+        self.max_transfer_bytes = 2 * 1024 ** 3
+        self.max_incoming_transfers = 8      # manifests beyond these limits are ignored
+        self.max_incoming_bytes = 2 * 1024 ** 3
+        self.transfer_timeout = 600          # incomplete incoming transfers are dropped after this
+        self.transfer_keep = 300             # sent transfers are kept this long for resend requests
+        self.transfer_progress = None        # callable(topic, received_bytes, total_bytes)
+        self.incoming_transfers = {}         # transfer id → IncomingTransfer
+        self.outgoing_transfers = {}         # transfer id → OutgoingTransfer
+        self._transfers_lock = threading.Lock()
 
 
         self.broker = broker
         self.port = port
 
+        # QoS>0 in-flight window, can only be changed before connecting
+        self.max_inflight = max_inflight
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.max_queued_messages_set(0)
+
+        # Subscription changes the server has not seen, sent on the next CONNACK
+        # when the session was resumed (otherwise everything is resubscribed)
+        self.subscribe_batch_size = 200
+        self._unsent_subscribes = set()
+        self._unsent_unsubscribes = set()
+        self._unsent_lock = threading.Lock()
+
+        # SUBACK/UNSUBACK tracking for SubscribeMany and UnsubscribeMany
+        self._ack_lock = threading.RLock()
+        self._ack_pending = {}     # mid → ("S" or "U", [topic filters])
+        self._ack_waiters = {}     # ("S" or "U", topic) → [AckTracker]
+        self._barriers = set()     # barrier topics waiting for their SUBACK
+
+        # Set on CONNACK, publishes before that wait in the offline queue
+        self.connected = threading.Event()
+        self._offline_queue = deque(maxlen=10000)
+        self._offline_lock = threading.Lock()
+
         # Bind callbacks
         self.client.username_pw_set(username=user, password=passw)
         self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
+        self.client.on_publish = self.on_publish
+        self.client.on_subscribe = self.on_subscribe
+        self.client.on_unsubscribe = self.on_unsubscribe
+
+        # Values held back by set_publish_rate are sent at interpreter exit
+        _open_brokers.add(self)
+
+        # Connect to broker in the background, connect=False gives an offline broker for benchmarks.
+        # Publishes made before CONNACK are queued and sent in order once connected.
+        if connect:
+            if session_expiry:
+                properties = Properties(PacketTypes.CONNECT)
+                properties.SessionExpiryInterval = int(session_expiry)
+                # The first connect starts clean: a session left by an earlier run
+                # holds subscriptions this process never made and cannot unsubscribe.
+                # Reconnects after that resume the session.
+                self.client.connect_async(broker, port, 60, clean_start=mqtt.MQTT_CLEAN_START_FIRST_ONLY,
+                                          properties=properties)
+            else:
+                self.client.connect_async(broker, port, 60)
+            self.client.loop_start()
 
-        # Connect to broker
-        self.client.connect(broker, port, 60)
-        self.client.loop_start()
+    def on_publish(self, client, userdata, mid, *args):
+        if self.publisher is not None:
+            self.publisher.on_publish(mid)
 
     def on_connect(self, client, userdata, flags, rc, properties=None):
         print(f"Connected with result code {rc}")
-        for topic in self.subscriptions.keys():
-            self.client.subscribe(topic)
+        if getattr(rc, "is_failure", rc != 0):
+            return
+
+        if isinstance(flags, dict):
+            session_present = flags.get("session present", False)
+        else:
+            session_present = getattr(flags, "session_present", False)
+
+        with self._unsent_lock:
+            unsent_subscribes = self._unsent_subscribes
+            unsent_unsubscribes = self._unsent_unsubscribes
+            self._unsent_subscribes = set()
+            self._unsent_unsubscribes = set()
+
+        # Packets without an acknowledgement before the connection dropped are sent again
+        with self._ack_lock:
+            stale = list(self._ack_pending.values())
+            self._ack_pending.clear()
+        for kind, topics in stale:
+            topics = [t for t in topics if not t.startswith("$private/")]
+            if kind == "S":
+                unsent_subscribes.update(topics)
+            else:
+                unsent_unsubscribes.update(topics)
+
+        if session_present:
+            # The server kept our subscriptions, only send what changed while offline
+            if unsent_unsubscribes:
+                self.mqtt_unsubscribe(sorted(unsent_unsubscribes))
+            topics = [t for t in unsent_subscribes if t in self.subscriptions]
+        else:
+            topics = self.subscriptions.keys()
+            # A new session has nothing to unsubscribe from
+            self.resolve_acks("U", unsent_unsubscribes, None)
+        self.mqtt_subscribe(topics)
+        for barrier in list(self._barriers):
+            self.send_barrier(barrier)
+        self.resume_transfers()
+
+        # Send what was published while offline, then let publishes through directly
+        with self._offline_lock:
+            while self._offline_queue:
+                self.client.publish(*self._offline_queue.popleft())
+            self.connected.set()
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        self.connected.clear()
+
+    def mqtt_subscribe(self, topics):
+        """Subscribe to topics and their $private twins, many topics per SUBSCRIBE packet."""
+        # QoS 1 so a persistent session queues messages while we are disconnected
+        qos = 1 if self.session_expiry else 0
+        filters = []
+        for topic in topics:
+            filters.append((topic, qos))
+            filters.append((f"$private/{self.client_id}/{topic}", qos))
+
+        for start in range(0, len(filters), self.subscribe_batch_size):
+            batch = filters[start:start + self.subscribe_batch_size]
+            with self._ack_lock:
+                result, mid = self.client.subscribe(batch)
+                if result == mqtt.MQTT_ERR_SUCCESS:
+                    self._ack_pending[mid] = ("S", [topic for topic, _ in batch])
+            if result != mqtt.MQTT_ERR_SUCCESS:
+                with self._unsent_lock:
+                    for topic, _ in batch:
+                        if not topic.startswith("$private/"):
+                            self._unsent_subscribes.add(topic)
+                            self._unsent_unsubscribes.discard(topic)
+
+    def mqtt_unsubscribe(self, topics):
+        """Unsubscribe from topics and their $private twins in as few packets as possible."""
+        filters = []
+        for topic in topics:
+            filters.append(topic)
+            filters.append(f"$private/{self.client_id}/{topic}")
+
+        for start in range(0, len(filters), self.subscribe_batch_size):
+            batch = filters[start:start + self.subscribe_batch_size]
+            with self._ack_lock:
+                result, mid = self.client.unsubscribe(batch)
+                if result == mqtt.MQTT_ERR_SUCCESS:
+                    self._ack_pending[mid] = ("U", list(batch))
+            if result != mqtt.MQTT_ERR_SUCCESS:
+                with self._unsent_lock:
+                    for topic in batch:
+                        if not topic.startswith("$private/"):
+                            self._unsent_unsubscribes.add(topic)
+                            self._unsent_subscribes.discard(topic)
+
+    def on_subscribe(self, client, userdata, mid, reason_codes, properties=None):
+        self.acknowledge(mid, reason_codes)
+
+    def on_unsubscribe(self, client, userdata, mid, properties=None, reason_codes=None):
+        self.acknowledge(mid, reason_codes)
+
+    def acknowledge(self, mid, codes):
+        """Match a SUBACK/UNSUBACK to the filters of its packet."""
+        with self._ack_lock:
+            pending = self._ack_pending.pop(mid, None)
+        if pending is None:
+            return
+        kind, topics = pending
+        if not isinstance(codes, (list, tuple)):
+            codes = [codes] * len(topics)
+
+        barriers = [t for t in topics if t in self._barriers]
+        for topic, code in zip(topics, codes):
+            self.resolve_acks(kind, (topic,), code)
+
+        # A barrier has done its job once acknowledged
+        for barrier in barriers:
+            self._barriers.discard(barrier)
+            self.client.unsubscribe(barrier)
+
+    def resolve_acks(self, kind, topics, code):
+        done = []
+        with self._ack_lock:
+            for topic in topics:
+                for tracker in self._ack_waiters.pop((kind, topic), ()):
+                    if tracker.ack(topic, code):
+                        done.append(tracker)
+        for tracker in done:
+            tracker.finish()
+
+    def track_acks(self, kind, topics, hidden=()):
+        """AckTracker for topics, registered before anything is sent so no ack is missed."""
+        tracker = AckTracker(topics, hidden)
+        with self._ack_lock:
+            for topic in tracker.waiting:
+                self._ack_waiters.setdefault((kind, topic), []).append(tracker)
+        return tracker
+
+    def send_barrier(self, barrier):
+        # Servers send retained messages right after each SUBACK, so the SUBACK
+        # of a later subscription means earlier retained messages have arrived
+        self._barriers.add(barrier)
+        with self._ack_lock:
+            result, mid = self.client.subscribe(barrier, 0)
+            if result == mqtt.MQTT_ERR_SUCCESS:
+                self._ack_pending[mid] = ("S", [barrier])
+
+    def wait_connected(self, timeout=None):
+        """Wait until the connection is up, returns False on timeout."""
+        return self.connected.wait(timeout)
+
+    def send_publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        """client.publish, but queued until the connection is up.
+
+        Returns the paho MQTTMessageInfo, or None if the message was queued.
+        """
+        if not self.connected.is_set():
+            with self._offline_lock:
+                if not self.connected.is_set():
+                    if len(self._offline_queue) == self._offline_queue.maxlen:
+                        self.DebugPrint("Offline queue full, dropped the oldest message", True)
+                    self._offline_queue.append((topic, payload, qos, retain, properties))
+                    return None
+        return self.client.publish(topic, payload, qos, retain, properties)
 
     class UpdateOperation:
-        def __init__(self, broker, topic_root, jsonpath, new_value, timeout=10):
+        """All pending JSONPath updates for one topic_root.
+
+        Updates are applied in order to a single parsed copy of the document,
+        seeded from the cache when it can be trusted, otherwise from the next
+        message on the topic. Everything added within the flush window goes
+        out as one publish.
+        """
+
+        def __init__(self, broker, topic_root, timeout=10):
             self.broker = broker
             self.topic_root = topic_root
-            self.jsonpath = jsonpath
-            self.new_value = new_value
+            self.updates = []    # [(jsonpath, new_value), ...]
+            self.base = NOT_DECODED
+            self.base_raw = None   # Serialized base, needed to send a delta
             self.deadline = time.time() + timeout
+            self.subscribed = False
+            self.done = False
+            self.timer = None      # Deadline of the wait for a base or of the flush window
+
+        def add(self, jsonpath, new_value):
+            # Called with broker._updates_lock held
+            self.updates.append((jsonpath, new_value))
+
+        def start(self):
+            cached = self.broker.get_update_base(self.topic_root)
+            if cached is not None:
+                self.set_base(cached)
+                return
 
-        def handler(self, full_topic, payload, msg_type: message_type):
-            # Only act on the correct topic
-            #if full_topic != self.topic_root:
-            #    return
+            # Wait for the next message (normally the retained value)
+            self.subscribed = True
+            self.broker.Subscribe(self.topic_root, self.handler)
+            self.timer = self.broker.deadlines.schedule(self.deadline - time.time(), self.cleanup)
 
+        def handler(self, full_topic, payload, msg_type: message_type):
             # Timeout?
             if time.time() > self.deadline:
                 self.cleanup()
                 return
-            
+            self.set_base(payload)
+
+        def set_base(self, payload):
             #Check if payload is null
             if payload is None:
                 base = {}
@@ -358,44 +2678,116 @@ class Broker:
                     if not isinstance(payload, (dict, list)):
                         base = json.loads(payload)
                     else:
-                        base = payload
+                        base = copy.deepcopy(payload)
+
+
+                except Exception:
+                    self.cleanup()
+                    print("JSON update operation failed: could not parse existing data: " + str(payload))
+                    return
+
+            with self.broker._updates_lock:
+                if self.done or self.base is not NOT_DECODED:
+                    return
+                self.base = base
+                if isinstance(payload, (str, bytes, bytearray)):
+                    self.base_raw = payload
+
+            # Let more updates to the same document join this publish
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = self.broker.deadlines.schedule(self.broker.update_flush_window, self.flush)
+
+        def flush(self):
+            # Take the updates, stop accepting new ones and cache the result in
+            # one step, so an update arriving right after this is seeded from
+            # the new document and not from the one this publish replaces
+            with self.broker._updates_lock:
+                if self.done:
+                    return
+                self.done = True
+
+                base = self.base
+                for jsonpath, new_value in self.updates:
+                    # Apply JSONPath update
+                    try:
+                        base = self.broker.jsonpath_cache.update(jsonpath, base, new_value)
+                    except Exception:
+                        # Silently ignore JSONPath problems
+                        pass
 
+                new_json = json.dumps(base).encode("utf-8")
+                self.broker.cache_payload(self.topic_root, new_json, msg_type=message_type.PENDING_UPDATE)
 
-                except Exception:
-                    self.cleanup()
-                    print("JSON update operation failed: could not parse existing data: " + str(payload))
-                    return
+                if self.broker.pending_updates.get(self.topic_root) is self:
+                    del self.broker.pending_updates[self.topic_root]
 
-            # Apply JSONPath update
-            try:
-                expr = jsonpath_parse(self.jsonpath)
-                expr.update(base, self.new_value)
-            except Exception:
-                # Silently ignore JSONPath problems
-                self.cleanup()
-                return
+            # Delta mode: send only a merge patch, flagged in the properties
+            if not (self.broker.delta_updates and self.publish_patch(base, new_json)):
+                # Publish full updated JSON back to topic
+                self.broker.send_publish(self.topic_root, new_json, qos=0, retain=False)
+                self.broker.patch_stats["bytes_full"] += len(new_json)
 
-            # Publish full updated JSON back to topic
-            new_json = json.dumps(base).encode("utf-8")
-            self.broker.client.publish(self.topic_root, new_json, qos=0, retain=False)
-            self.broker.cache_payload(self.topic_root, new_json, msg_type=message_type.PENDING_UPDATE)
+            self.broker.update_publishes += 1
 
             # After successful update → clean up
             self.cleanup()
 
+        def publish_patch(self, new_doc, new_json):
+            """Publish new_doc as a merge patch against base_raw, False if that is not possible."""
+            if self.base_raw is None:
+                return False
+            try:
+                patch = make_merge_patch(json.loads(self.base_raw), new_doc)
+            except ValueError:
+                return False
+
+            patch_json = json.dumps(patch).encode("utf-8")
+
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.ContentType = MERGE_PATCH_CONTENT_TYPE
+            properties.UserProperty = [
+                ("dataspace-base", payload_digest(self.base_raw)),
+                ("dataspace-result", payload_digest(new_json)),
+            ]
+            self.broker.send_publish(self.topic_root, patch_json, qos=0, retain=False, properties=properties)
+
+            stats = self.broker.patch_stats
+            stats["sent"] += 1
+            stats["bytes_sent"] += len(patch_json)
+            stats["bytes_full"] += len(new_json)
+            return True
+
         def cleanup(self):
-            # Remove from pending list
-            ops = self.broker.pending_updates.get(self.topic_root, [])
-            if self in ops:
-                ops.remove(self)
-            if not ops:
-                self.broker.pending_updates.pop(self.topic_root, None)
+            # Remove from pending updates, later updates start a new operation
+            with self.broker._updates_lock:
+                self.done = True
+                if self.broker.pending_updates.get(self.topic_root) is self:
+                    del self.broker.pending_updates[self.topic_root]
+
+            if self.timer is not None:
+                self.timer.cancel()
 
             # Unsubscribe the temporary handler
-            try:
-                self.broker.Unsubscribe(self.topic_root, self.handler)
-            except:
-                pass
+            if self.subscribed:
+                self.subscribed = False
+                try:
+                    self.broker.Unsubscribe(self.topic_root, self.handler)
+                except:
+                    pass
+
+    def get_update_base(self, topic):
+        """Cached payload to apply JSONPath updates to, if it can be trusted to be current.
+
+        That is when the topic has a live subscription or the value is at most
+        update_max_age seconds old.
+        """
+        entry = self.cache_entry(topic)
+        if entry is None:
+            return None
+        if self.has_subscribers(topic) or time.time() - entry.ts <= self.update_max_age:
+            return entry.payload
+        return None
 
 
     def Publish(self, topic, payload=None, qos=0, retain=False, properties=None, timeout=2):
@@ -407,10 +2799,23 @@ class Broker:
 
             #Check if payload is text or binary otherwise convert to utf-8 if it is object to json.dumps
 
-            if not isinstance(payload, (str, bytes, bytearray)):
-                payload = json.dumps(payload).encode("utf-8")
+            payload = encode_payload(payload)
 
-            self.client.publish(topic_root, payload, qos, retain, properties)
+            # Payloads over chunk_threshold go out in chunks (blocks until sent, not
+            # rate limited). Chunks cannot be retained and the manifest carries its
+            # own properties, so retained publishes and publishes with properties
+            # are always sent whole.
+            if (self.chunk_threshold is not None and len(payload) > self.chunk_threshold
+                    and not retain and properties is None):
+                self.PublishChunked(topic_root, payload, qos=max(qos, 1))
+                return
+
+            # Large payloads are compressed on the wire, the cache keeps the original
+            data, data_properties = self.compressor.compress(topic_root, payload, properties)
+
+            # Rate limited topics keep only the newest value until it may be sent
+            if self.coalescer is None or not self.coalescer.publish(topic_root, data, qos, retain, data_properties):
+                self.send_publish(topic_root, data, qos, retain, data_properties)
             self.cache_payload(topic_root, payload, msg_type=message_type.PENDING_UPDATE)
             return
 
@@ -428,19 +2833,124 @@ class Broker:
             else:
                 new_value = payload
 
-        # Create update operation
-        op = self.UpdateOperation(self, topic_root, jsonpath, new_value, timeout)
+        # Join the pending operation for this document or create a new one
+        with self._updates_lock:
+            op = self.pending_updates.get(topic_root)
+            created = op is None
+            if created:
+                op = self.UpdateOperation(self, topic_root, timeout)
+                self.pending_updates[topic_root] = op
+            op.add(jsonpath, new_value)
+
+        # Seeded from the cache, or fires on the next message
+        if created:
+            op.start()
+
+
+
+    def start_publisher(self, max_queue_bytes=64 * 1024 * 1024, max_inflight=None, **kwargs):
+        """Start (or return the running) background publisher used by PublishMany.
+
+        max_inflight defaults to the Broker's window, which paho does not allow
+        to change once connected.
+        """
+        if max_inflight is None:
+            max_inflight = self.max_inflight
+        if self.publisher is None:
+            self.publisher = QueuedPublisher(self.client, max_queue_bytes=max_queue_bytes,
+                                             max_inflight=max_inflight, connected=self.connected, **kwargs)
+        return self.publisher
+
+    def PublishMany(self, items, qos=0, retain=False, timeout=None):
+        """Queue many messages on the background publisher.
+
+        items are (topic, payload) or (topic, payload, qos, retain[, properties]).
+        Blocks while the outgoing queue is over its byte limit. Topics with a
+        JSONPath go through Publish. Returns the number of messages queued.
+        """
+        publisher = self.start_publisher()
+        count = 0
+        for item in items:
+            topic, payload = item[0], item[1]
+            item_qos = item[2] if len(item) > 2 else qos
+            item_retain = item[3] if len(item) > 3 else retain
+            properties = item[4] if len(item) > 4 else None
+
+            topic_root, jsonpath = self.parse_topic_jsonpath(topic)
+            if jsonpath:
+                self.Publish(topic, payload, item_qos, item_retain, properties)
+                count += 1
+                continue
+
+            payload = encode_payload(payload)
+            data, data_properties = self.compressor.compress(topic_root, payload, properties)
+            if not publisher.publish(topic_root, data, item_qos, item_retain, data_properties, timeout):
+                break
+            self.cache_payload(topic_root, payload, msg_type=message_type.PENDING_UPDATE)
+            count += 1
+        return count
 
-        # Store operation
-        if topic_root not in self.pending_updates:
-            self.pending_updates[topic_root] = []
-        self.pending_updates[topic_root].append(op)
+    def set_publish_rate(self, topic_or_prefix, min_interval=None, rate=None, burst=1):
+        """Limit how often Publish sends to each topic under topic_or_prefix.
 
-        # Subscribe temporary handler
-        # It will fire *on the next message*, or cached value
-        self.Subscribe(topic_root, op.handler)
+        Give either min_interval (seconds between messages) or rate (messages
+        per second, with burst). Values published faster than that are
+        coalesced and only the newest one is sent. Both None removes the rule.
+        """
+        if min_interval is not None:
+            rate = 1.0 / min_interval
+        if self.coalescer is None:
+            if rate is None:
+                return
+            self.coalescer = PublishCoalescer(self.send_publish)
+        self.coalescer.set_rate(topic_or_prefix, rate, burst)
 
+    def enable_compression(self, encoding="zlib", threshold=1024, level=None):
+        """Compress published payloads of at least threshold bytes.
 
+        encoding is "zlib" or "zstd" (needs zstandard), None turns it off.
+        Receivers need a client that understands the dataspace-encoding
+        property, this one always decompresses.
+        """
+        if encoding is not None:
+            compress_payload(b"", encoding, level)   # Fail early on unknown encodings
+        self.compressor.encoding = encoding
+        self.compressor.threshold = threshold
+        self.compressor.level = level
+
+    def compression_stats(self, topic=None):
+        return self.compressor.stats(topic)
+
+    def flush_publishes(self, timeout=10):
+        """Send values held back by set_publish_rate now and wait until they are written."""
+        deadline = time.time() + timeout
+        infos = self.coalescer.flush() if self.coalescer is not None else []
+        if self.publisher is not None:
+            self.publisher.flush(timeout)
+        for info in infos:
+            if info is not None and info.rc == mqtt.MQTT_ERR_SUCCESS:
+                try:
+                    info.wait_for_publish(max(deadline - time.time(), 0))
+                except (RuntimeError, ValueError):
+                    pass
+
+    def close(self, timeout=10):
+        """Flush queued publishes, stop worker threads and disconnect."""
+        _open_brokers.discard(self)
+        if self.coalescer is not None:
+            self.coalescer.close()
+            self.coalescer = None
+        if self.publisher is not None:
+            self.publisher.close(flush=True, timeout=timeout)
+            self.publisher = None
+        if self.dispatcher is not None:
+            self.dispatcher.close(timeout=timeout)
+            self.dispatcher = None
+        self.client.disconnect()
+        self.client.loop_stop()
+        if self._client_id_lease is not None:
+            self._client_id_lease.close()
+            self._client_id_lease = None
 
     def parse_topic_jsonpath(self,url_path: str):
         idx = url_path.rfind('$')
@@ -459,83 +2969,395 @@ class Broker:
         return url, jsonpath
 
 
-    def ApplyJsonPath(self, payload, jsonpath):
+    def DecodeJson(self, payload):
+        """Parse payload as JSON, returns NOT_JSON if it is not valid JSON."""
+        try:
+            return json.loads(payload)
+        except Exception:
+            return NOT_JSON
+
+    def ApplyJsonPath(self, payload, jsonpath, json_payload=NOT_DECODED):
         # 1. Ingen JSONPath → returnera hela payload
         if not jsonpath:
             return payload
-        
 
-        try:
-            json_payload = json.loads(payload)
-        except Exception as e:
-            # Payload är inte giltig JSON → returnera None
+        # json_payload kan skickas in om payload redan är avkodad
+        if json_payload is NOT_DECODED:
+            json_payload = self.DecodeJson(payload)
+
+        if json_payload is NOT_JSON:
+            # Payload är inte giltig JSON → returnera payload oförändrad
             return payload
 
         try:
-            # 2. Kompilera JSONPath
-            expr = jsonpath_parse(jsonpath)
+            # 2. Hämta kompilerat uttryck från cachen och utför matchning
+            matches = self.jsonpath_cache.find(jsonpath, json_payload)
 
-            # 3. Utför matchning
-            matches = expr.find(json_payload)
-
-            # 4. Ingen träff → returnera None
+            # 3. Ingen träff → returnera None
             if not matches:
                 return None
 
-            # 5. Om det bara finns en träff → returnera värdet
+            # 4. Om det bara finns en träff → returnera värdet
             if len(matches) == 1:
-                return matches[0].value
+                return matches[0]
 
-            # 6. Flera träffar → returnera en lista av värden
-            return [m.value for m in matches]
+            # 5. Flera träffar → returnera en lista av värden
+            return matches
 
         except Exception as e:
             # JSONPath-fel → returnera None
             return None
 
     def Subscribe(self, topic, handler=default_handler):
+        """Subscribe handler to topic (optionally with a JSONPath).
+
+        Subscribing the same handler and JSONPath again only increases its
+        refcount. Returns the subscription id, which can be given to
+        Unsubscribe instead of the topic and handler.
+        """
 
         topic, jsonpath = self.parse_topic_jsonpath(topic)
 
-        if topic in self.subscriptions.keys():
-            if (handler, jsonpath) not in self.subscriptions[topic]:
-                self.subscriptions[topic].append((handler, jsonpath))
-                cached_payload = self.get_cached(topic)
-                if cached_payload and callable(handler):
-                    prefix = "mqtt://"
-                    payload = self.ApplyJsonPath(cached_payload, jsonpath)
-                    handler(prefix + self.broker + "/" + topic, payload, message_type.CACHED)
+        with self.subscriptions.lock:
+            sub, new_topic, new_entry = self.subscriptions.add(topic, handler, jsonpath)
+            if new_topic:
+                self.router.add(topic)
+                self.mqtt_subscribe([topic])
+
+        if new_entry and not new_topic and callable(handler):
+            self.replay_cached(topic, handler, jsonpath)
+
+        return sub.id
+
+    def SubscribeMany(self, topics, handler=default_handler, wait_retained=True):
+        """Subscribe handler to many topics, packing the filters into few SUBSCRIBE packets.
+
+        Returns a concurrent.futures.Future that resolves to {topic: reason code}
+        once the server has acknowledged every new topic. With wait_retained
+        the future also waits until the retained values of those topics have
+        been delivered.
+        """
+        new_topics = []
+        replay = []
+        with self.subscriptions.lock:
+            for topic in topics:
+                topic, jsonpath = self.parse_topic_jsonpath(topic)
+                sub, new_topic, new_entry = self.subscriptions.add(topic, handler, jsonpath)
+                if new_topic:
+                    self.router.add(topic)
+                    new_topics.append(topic)
+                elif new_entry and callable(handler):
+                    replay.append((topic, jsonpath))
+
+        # Topics subscribed earlier but not yet acknowledged are waited for as well
+        with self._ack_lock:
+            in_flight = {t for kind, filters in self._ack_pending.values() if kind == "S" for t in filters}
+        with self._unsent_lock:
+            in_flight |= self._unsent_subscribes
+        waiting = new_topics + [t for t, _ in replay if t in in_flight]
+
+        barrier = f"$private/{self.client_id}/.barrier/{uuid.uuid4().hex}" if wait_retained and waiting else None
+        tracker = self.track_acks("S", waiting, [barrier] if barrier else ())
+        self.mqtt_subscribe(new_topics)
+        if barrier:
+            self.send_barrier(barrier)
+
+        for topic, jsonpath in replay:
+            self.replay_cached(topic, handler, jsonpath)
+        return tracker.future
+
+    def UnsubscribeMany(self, topics, handler=default_handler):
+        """Unsubscribe handler from many topics in few UNSUBSCRIBE packets.
+
+        Returns a concurrent.futures.Future that resolves to {topic: reason code}
+        once the server has acknowledged every topic that was dropped.
+        """
+        empty = []
+        with self.subscriptions.lock:
+            for topic in topics:
+                topic, jsonpath = self.parse_topic_jsonpath(topic)
+                removed, topic_empty = self.subscriptions.remove(topic, handler, jsonpath)
+                if topic_empty:
+                    self.router.remove(topic)
+                    empty.append(topic)
+
+        tracker = self.track_acks("U", empty)
+        self.mqtt_unsubscribe(empty)
+        return tracker.future
+
+    # Already subscribed topics get no new retained message from the server,
+    # so a new handler is fed from the cache instead
+    def replay_cached(self, topic_filter, handler, jsonpath=None):
+        if has_wildcards(topic_filter):
+            topics = [t for t in self.cached.keys() if topic_matches(topic_filter, t)]
         else:
-            self.subscriptions[topic] = [(handler, jsonpath)]
-            self.client.subscribe(topic)
-            self.client.subscribe(f"$private/{self.client_id}/{topic}")
+            topics = [topic_filter]
+
+        for topic in topics:
+            cached_payload = self.get_cached(topic)
+            if cached_payload:
+                payload = self.ApplyJsonPath(cached_payload, jsonpath)
+                self.call_handler(handler, topic, payload, message_type.CACHED, jsonpath)
+
+    def call_handler(self, handler, topic, payload, msg_type: message_type, jsonpath=None):
+        """Call a 3-argument or a message_handler outside of deliver."""
+        if wants_message(handler):
+            return handler(Message(topic, self.broker, payload, msg_type, jsonpath=jsonpath,
+                                   decoders=self.payload_decoders))
+        return handler("mqtt://" + self.broker + "/" + topic, payload, msg_type)
 
     #If there is a cached message for the topic return it
     def get_cached(self, topic):
-        if topic in self.cached.keys():
-            return self.cached[topic]
-        return None
+        entry = self.cache_entry(topic)
+        return None if entry is None else entry.payload
 
+    def cache_entry(self, topic, from_disk=False):
+        """CacheEntry for topic from memory, with from_disk also from the persistent cache.
 
-    def Get(self, topic, blocking=True, handler=default_handler, timeout=10):
-        get_obj = GetObject(topic, handler)
-        self.gets.append((topic, get_obj))
+        Disk entries are not put in the memory cache, which only holds values
+        received by this process. Callers reading from disk must check the
+        age (or digest) of what they get.
+        """
+        entry = self.cached.get_entry(topic)
+        if entry is None and from_disk and self.persistent_cache is not None and self.cache:
+            stored = self.persistent_cache.get(self.broker, topic)
+            if stored is not None:
+                payload, ts, msg_type = stored
+                entry = CacheEntry(payload, ts, msg_type, _payload_size(topic, payload))
+        return entry
+
+    def get_fresh_cached(self, topic, max_age):
+        """Return the CacheEntry for topic if it is at most max_age seconds old."""
+        entry = self.cache_entry(topic, from_disk=True)
+        if entry is None or time.time() - entry.ts > max_age:
+            return None
+        return entry
+
+    def has_subscribers(self, topic):
+        return bool(self.router.match(topic))
+
+
+    def Get(self, topic, blocking=True, handler=default_handler, timeout=10, max_age=None):
+        """Get the current value of topic.
+
+        timeout="auto" picks the deadline from measured answer times (at most
+        get_timeout_cap seconds). Such Gets of topics that recently timed out
+        are answered with None right away for missing_ttl seconds, unless a
+        value arrives. A number waits that long and always asks the server.
+        """
+        topic_root, jsonpath = self.parse_topic_jsonpath(topic)
 
-        self.Subscribe(topic,get_obj.update)
+        # A fresh enough cached value is returned without a network round-trip
+        if max_age is not None:
+            entry = self.get_fresh_cached(topic_root, max_age)
+            if entry is not None:
+                self.get_cache_hits += 1
+                payload = self.ApplyJsonPath(entry.payload, jsonpath)
+                if handler is None:
+                    return payload
+                elif callable(handler):
+                    result = self.call_handler(handler, topic, payload, message_type.CACHED)
+                    return result if blocking else None
+                return None
+            self.get_cache_misses += 1
 
-        if blocking:
-            if not get_obj.event.wait(timeout=timeout):
-                print("Timeout")
-                self.Unsubscribe(topic, get_obj.update)
+        adaptive = timeout == "auto"
+        timeout = self.get_deadline(timeout)
 
+        if blocking and adaptive and self.known_missing(topic_root):
+            self.get_negative_hits += 1
             if handler is None:
-                return get_obj.payload
-            elif callable(get_obj.handler):
-                prefix = "mqtt://"
-                return get_obj.handler(prefix + self.broker + "/" + topic, get_obj.payload,get_obj.msg_type)
+                return None
+            elif callable(handler):
+                return self.call_handler(handler, topic, None, None)
+            return None
+
+        if not blocking:
+            get_obj = GetObject(topic, handler)
+            self.add_get(get_obj)
+            self.Subscribe(topic,get_obj.update)
+            if get_obj.event.is_set():
+                # Answered from the cache on subscribe
+                self.CancelGet(get_obj)
+            elif timeout is not None:
+                # Drop the request if no value arrives before the deadline
+                get_obj.timer = self.deadlines.schedule(timeout, self.CancelGet, get_obj)
+            return None
 
+        # Concurrent Gets of the same topic (and JSONPath) share one request
+        with self._flights_lock:
+            flight = self.get_flights.get(topic)
+            leader = flight is None
+            if leader:
+                flight = self.get_flights[topic] = GetFlight(GetObject(topic))
+            else:
+                self.get_coalesced += 1
+            flight.waiters += 1
+        get_obj = flight.get_obj
+
+        started = time.time()
+        if leader:
+            self.add_get(get_obj)
+            self.Subscribe(topic,get_obj.update)
+
+        if get_obj.event.wait(timeout=timeout):
+            self.get_answered += 1
+            if leader and get_obj.msg_type != message_type.CACHED:
+                self.get_latency.record(time.time() - started)
+        else:
+            self.get_timeouts += 1
+            self.DebugPrint(f"Timeout getting {topic} after {timeout:.2f} s")
+            if adaptive and self.connected.is_set():
+                self.note_missing(topic_root)
+
+        # The last waiter removes the request, answered, timed out or served
+        # from the cache on subscribe
+        with self._flights_lock:
+            flight.waiters -= 1
+            last = flight.waiters == 0
+            if last and self.get_flights.get(topic) is flight:
+                del self.get_flights[topic]
+        if last:
+            self.CancelGet(get_obj)
+
+        if handler is None:
+            return get_obj.payload
+        elif callable(handler):
+            return self.call_handler(handler, topic, get_obj.payload, get_obj.msg_type)
         return None
 
+    def get_deadline(self, timeout):
+        """Seconds a Get waits, "auto" adapts to the measured answer times."""
+        if timeout != "auto":
+            return timeout
+        # While offline the connect time is unknown, so wait the full cap
+        if not self.connected.is_set():
+            return self.get_timeout_cap
+        return self.get_latency.timeout(self.get_timeout_cap)
+
+    def get_waiters(self, topic):
+        """Number of threads waiting in Get for topic (with JSONPath, if any)."""
+        with self._flights_lock:
+            flight = self.get_flights.get(topic)
+            return 0 if flight is None else flight.waiters
+
+    def known_missing(self, topic):
+        expires = self.missing.get(topic)
+        if expires is None:
+            return False
+        if time.time() < expires:
+            return True
+        self.missing.pop(topic, None)
+        return False
+
+    def note_missing(self, topic):
+        if self.missing_ttl <= 0:
+            return
+        if len(self.missing) >= 10000:
+            now = time.time()
+            self.missing = {t: e for t, e in self.missing.items() if e > now}
+        self.missing[topic] = time.time() + self.missing_ttl
+
+    def get_stats(self):
+        """Get counters and the current adaptive deadline."""
+        return {
+            "answered": self.get_answered,
+            "timeouts": self.get_timeouts,
+            "cache_hits": self.get_cache_hits,
+            "cache_misses": self.get_cache_misses,
+            "negative_hits": self.get_negative_hits,
+            "coalesced": self.get_coalesced,
+            "in_flight": len(self.get_flights),
+            "known_missing": len(self.missing),
+            "latency_ewma": self.get_latency.ewma,
+            "latency_p99": self.get_latency.p99(),
+            "adaptive_timeout": self.get_latency.timeout(self.get_timeout_cap),
+        }
+
+    def GetToFile(self, topic, path, timeout=10, max_age=None):
+        """Get topic and write the payload to path without copying it, returns bytes written or None."""
+        payload = self.Get(topic, handler=None, timeout=timeout, max_age=max_age)
+        if payload is None:
+            return None
+        return write_payload(encode_payload(payload), path)
+
+    def GetArray(self, topic, dtype="uint8", count=-1, offset=0, timeout=10, max_age=None):
+        """Get topic as a read-only numpy array sharing memory with the cached payload."""
+        import numpy as np
+        payload = self.Get(topic, handler=None, timeout=timeout, max_age=max_age)
+        if payload is None:
+            return None
+        return np.frombuffer(payload_view(encode_payload(payload)), dtype=dtype, count=count, offset=offset)
+
+    def GetMany(self, topics, timeout=10, max_age=None):
+        """Get several topics at once with one overall deadline.
+
+        All subscriptions are issued before waiting. Returns {topic: payload},
+        topics without an answer before the deadline map to GET_TIMEOUT.
+        """
+        deadline = time.time() + timeout
+        pending = self.start_gets(topics, max_age)
+        return self.collect_gets(pending, deadline)
+
+    def start_gets(self, topics, max_age=None):
+        """Subscribe to all topics without waiting, returns {topic: GetObject}."""
+        pending = {}
+        for topic in topics:
+            if topic in pending:
+                continue
+            get_obj = GetObject(topic)
+            pending[topic] = get_obj
+
+            if max_age is not None:
+                topic_root, jsonpath = self.parse_topic_jsonpath(topic)
+                entry = self.get_fresh_cached(topic_root, max_age)
+                if entry is not None:
+                    self.get_cache_hits += 1
+                    get_obj.update(topic, self.ApplyJsonPath(entry.payload, jsonpath), message_type.CACHED)
+                    continue
+                self.get_cache_misses += 1
+
+            self.add_get(get_obj)
+            self.Subscribe(topic, get_obj.update)
+        return pending
+
+    def collect_gets(self, pending, deadline):
+        """Wait for GetObjects from start_gets until deadline, then unsubscribe them."""
+        results = {}
+        for topic, get_obj in pending.items():
+            remaining = deadline - time.time()
+            if get_obj.event.wait(timeout=max(remaining, 0)):
+                results[topic] = get_obj.payload
+            else:
+                results[topic] = GET_TIMEOUT
+            self.CancelGet(get_obj)
+        return results
+
+    # Pending gets are indexed as subscribed topic (without JSONPath) →
+    # {GetObject.update: GetObject} so dispatch can check and remove them in O(1)
+    def add_get(self, get_obj):
+        topic_root, _ = self.parse_topic_jsonpath(get_obj.topic)
+        with self._gets_lock:
+            self.gets.setdefault(topic_root, {})[get_obj.update] = get_obj
+
+    def _pop_get(self, topic, handler):
+        with self._gets_lock:
+            pending = self.gets.get(topic)
+            if not pending:
+                return None
+            get_obj = pending.pop(handler, None)
+            if not pending:
+                del self.gets[topic]
+            return get_obj
+
+    def CancelGet(self, get_obj):
+        """Stop waiting for get_obj and remove its subscription, safe to call more than once."""
+        if get_obj.timer is not None:
+            get_obj.timer.cancel()
+        topic_root, _ = self.parse_topic_jsonpath(get_obj.topic)
+        if self._pop_get(topic_root, get_obj.update) is not None:
+            self.Unsubscribe(get_obj.topic, get_obj.update)
+
     def GetDataFrame(self, topic, timeout=10):
         import pandas as pd
         data = self.Get(topic, blocking=True, handler=None, timeout=timeout)
@@ -550,24 +3372,37 @@ class Broker:
         return df
 
     def Unsubscribe(self, topic, handler=default_handler):
-        topic, jsonpath = self.parse_topic_jsonpath(topic)
+        """Drop one reference to a subscription, topic may also be a subscription id."""
+        if isinstance(topic, int):
+            sub = self.subscriptions.by_id(topic)
+            if sub is None:
+                return
+            topic, handler, jsonpath = sub.topic, sub.handler, sub.jsonpath
+        else:
+            topic, jsonpath = self.parse_topic_jsonpath(topic)
 
-        if topic not in self.subscriptions:
-            return
-        if (handler, jsonpath) not in self.subscriptions[topic]:
-            return
-        self.subscriptions[topic].remove((handler, jsonpath))
-        if len(self.subscriptions[topic]) == 0:
-            self.client.unsubscribe(topic)
-            self.client.unsubscribe(f"$private/{self.client_id}/{topic}")
-            del self.subscriptions[topic]
+        with self.subscriptions.lock:
+            removed, topic_empty = self.subscriptions.remove(topic, handler, jsonpath)
+            if topic_empty:
+                self.mqtt_unsubscribe([topic])
+                self.router.remove(topic)
+
+        # Keep listening for resend requests of transfers on the topic
+        if topic_empty and self.outgoing_transfers:
+            with self._transfers_lock:
+                transfers = [t for t in self.outgoing_transfers.values() if t.reply_topic == topic]
+            for transfer in transfers[:1]:
+                self.listen_for_resends(transfer)
 
 
     def cache_payload(self, topic, payload,msg_type: message_type = message_type.PUBLIC):
+        # The topic has a value now
+        if self.missing:
+            self.missing.pop(topic, None)
         if self.cache:
-            self.cached[topic] = payload
-            self.cached_ts[topic] = int(time.time())
-            self.cached_msg_type[topic] = msg_type
+            entry = self.cached.put(topic, payload, msg_type)
+            if self.persistent_cache is not None:
+                self.persistent_cache.put(self.broker, topic, payload, entry.ts, msg_type)
 
     def on_message(self, client, userdata, msg):
         try:
@@ -576,43 +3411,329 @@ class Broker:
                 self.debug_msg.append(f"{int(time.time())} Update received: {msg.topic}")
                 self.debug_msg = self.debug_msg[-10:]
 
-            
+            received = time.time()
 
-            to_be_unsubscribed = []
+            # Strip the $private prefix and find all matching filters in one step
+            topic, is_private, topic_filters = self.router.route(msg.topic)
 
-            if msg.topic.find(f"$private/{self.client_id}/") == 0:
-                topic = msg.topic[len(f"$private/{self.client_id}/"):]
+            if is_private:
                 msg_type = message_type.PRIVATE
+            elif msg.retain == 1:
+                msg_type = message_type.RETAINED
             else:
-                topic = msg.topic
+                msg_type = message_type.PUBLIC
 
-                if msg.retain == 1:
-                   msg_type = message_type.RETAINED
-                else:               
-                    msg_type = message_type.PUBLIC
+            payload = msg.payload
+            properties = getattr(msg, "properties", None)
 
-            self.cache_payload(topic, msg.payload,msg_type=msg_type)
+            # Compressed payloads are cached and delivered decompressed
+            if properties is not None:
+                payload = self.compressor.decompress(topic, payload, properties)
 
-            if topic in self.subscriptions:
-                for (handler, jsonpath) in self.subscriptions[topic]:
+            # Chunks are collected until the whole payload has arrived
+            content_type = getattr(properties, "ContentType", None)
+            if content_type in CHUNK_CONTENT_TYPES:
+                payload, msg_type = self.handle_transfer_message(topic, payload, properties, content_type, msg_type)
+                if payload is None:
+                    return
 
-                    msg_payload = self.ApplyJsonPath(msg.payload, jsonpath)
+            # A merge patch is turned back into the full document before caching
+            if getattr(properties, "ContentType", None) == MERGE_PATCH_CONTENT_TYPE:
+                payload = self.apply_patch_message(topic, payload, properties)
+                if payload is None:
+                    return
 
-                    if callable(handler):
-                        prefix = "mqtt://"
-                        handler(prefix + self.broker + "/" + topic, msg_payload,msg_type)
+            self.cache_payload(topic, payload,msg_type=msg_type)
 
-                    if (topic, handler) in self.gets:
-                        to_be_unsubscribed.append((topic, handler))
+            self.lasttopic = msg.topic
 
-            for topic, handler in to_be_unsubscribed:
-                self.gets.remove((topic, handler))
-                self.Unsubscribe(topic, handler)
+            if not topic_filters:
+                return
 
-            self.lasttopic = msg.topic
+            # With a dispatcher the network thread only routes, handlers run
+            # on a worker that always serves this topic so order is kept
+            if self.dispatcher is not None:
+                self.dispatcher.submit(topic, self.deliver, topic, topic_filters, payload, msg_type,
+                                       properties, received)
+            else:
+                self.deliver(topic, topic_filters, payload, msg_type, properties, received)
         except:
             traceback.print_exc()
 
+    def PublishChunked(self, topic, payload, chunk_size=None, qos=1, progress=None, timeout=None):
+        """Publish a large payload as a manifest followed by numbered chunks.
+
+        Blocks until all chunks are handed over (PUBACK for qos 1), with at
+        most chunk_window chunks in flight. Chunked payloads are never
+        retained, use Publish(retain=True) for values later Gets must see.
+        Chunks of an interrupted connection are sent again by paho after
+        reconnect, and receivers can ask for chunks they missed for
+        transfer_keep seconds afterwards. Resend requests are published on
+        the topic itself, so only receivers allowed to publish there (the
+        same user or group namespace) can ask for them.
+
+        Args:
+            progress: callable(sent_bytes, total_bytes), called as chunks are acknowledged.
+            timeout:  Max seconds for the whole transfer, None waits forever.
+
+        Returns:
+            str: Transfer id.
+        """
+        topic, _ = self.parse_topic_jsonpath(topic)
+        payload = encode_payload(payload)
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        original = payload
+
+        # Compress the whole payload, not each chunk
+        payload, properties = self.compressor.compress(topic, payload)
+        encoding = user_properties(properties).get(CONTENT_ENCODING_PROPERTY)
+
+        transfer = OutgoingTransfer(topic, payload, chunk_size or self.chunk_size, qos, topic, encoding)
+        with self._transfers_lock:
+            self.expire_transfers()
+            self.outgoing_transfers[transfer.id] = transfer
+
+        self.listen_for_resends(transfer)
+        self.send_publish(topic, transfer.manifest, qos, False, transfer.manifest_properties())
+
+        deadline = None if timeout is None else time.time() + timeout
+        total = len(payload)
+        sent = 0
+        in_flight = deque()
+        for index in range(transfer.chunks):
+            data, chunk_properties = transfer.chunk(index)
+            in_flight.append((self.client.publish(topic, data, qos, False, chunk_properties), len(data)))
+            while len(in_flight) >= self.chunk_window or (index == transfer.chunks - 1 and in_flight):
+                info, size = in_flight.popleft()
+                self.wait_published(info, qos, deadline)
+                sent += size
+                if progress is not None:
+                    progress(sent, total)
+
+        transfer.finished = time.time()
+        self.cache_payload(topic, original, msg_type=message_type.PENDING_UPDATE)
+        return transfer.id
+
+    @staticmethod
+    def wait_published(info, qos, deadline):
+        # wait_for_publish raises while disconnected, but paho still sends
+        # queued QoS>0 messages after reconnecting, so poll in that case
+        while not info.is_published():
+            if info.rc != mqtt.MQTT_ERR_SUCCESS and qos == 0:
+                return
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError("Chunked transfer timed out")
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                info.wait_for_publish(remaining if remaining is not None else 1.0)
+            else:
+                time.sleep(0.05)
+
+    def handle_transfer_message(self, topic, payload, properties, content_type, msg_type):
+        """Handle a manifest, chunk or resend request.
+
+        Returns (payload, msg_type) when a transfer is complete, (None, None) otherwise.
+        """
+        if content_type == CHUNK_REQUEST_CONTENT_TYPE:
+            self.resend_chunks(json.loads(payload))
+            return None, None
+
+        if content_type == CHUNK_MANIFEST_CONTENT_TYPE:
+            manifest = json.loads(payload)
+            with self._transfers_lock:
+                self.expire_transfers()
+                transfer_id = manifest.get("transfer")
+                if transfer_id in self.incoming_transfers or transfer_id in self.outgoing_transfers:
+                    return None, None
+                size = int(manifest.get("size", 0))
+                if size > self.max_transfer_bytes:
+                    self.DebugPrint(f"Ignored chunked transfer to {topic}, {size} bytes is too large", True)
+                    return None, None
+                if (len(self.incoming_transfers) >= self.max_incoming_transfers or
+                        sum(t.size for t in self.incoming_transfers.values()) + size > self.max_incoming_bytes):
+                    self.DebugPrint(f"Ignored chunked transfer to {topic}, too many transfers in progress", True)
+                    return None, None
+                self.incoming_transfers[transfer_id] = IncomingTransfer(
+                    topic, manifest, getattr(properties, "ResponseTopic", None), msg_type)
+            return None, None
+
+        transfer_id, _, index = user_properties(properties).get(CHUNK_PROPERTY, "").partition(":")
+        with self._transfers_lock:
+            transfer = self.incoming_transfers.get(transfer_id)
+            if transfer is None or not transfer.add(int(index), payload):
+                return None, None
+            if transfer.complete:
+                del self.incoming_transfers[transfer_id]
+
+        if self.transfer_progress is not None:
+            try:
+                self.transfer_progress(topic, transfer.received_bytes, transfer.size)
+            except Exception:
+                traceback.print_exc()
+
+        if not transfer.complete:
+            return None, None
+        try:
+            return transfer.result(), transfer.msg_type
+        except ValueError as e:
+            self.DebugPrint(str(e), True)
+            return None, None
+
+    def resend_chunks(self, request):
+        """Publish the chunks a receiver asked for again."""
+        with self._transfers_lock:
+            transfer = self.outgoing_transfers.get(request.get("transfer"))
+        if transfer is None:
+            return
+        for index in request.get("missing", ()):
+            if 0 <= index < transfer.chunks:
+                data, properties = transfer.chunk(index)
+                self.client.publish(transfer.topic, data, transfer.qos, False, properties)
+                transfer.resent += 1
+
+    def listen_for_resends(self, transfer):
+        # Resend requests come on the transfer topic, where the ACLs from
+        # add_user_with_role let writers of the namespace publish ($private
+        # topics are receive-only). noLocal keeps our own chunks from coming
+        # back, unless the topic is subscribed anyway.
+        if transfer.reply_topic not in self.subscriptions:
+            self.client.subscribe(transfer.reply_topic, options=SubscribeOptions(qos=1, noLocal=True))
+
+    def resume_transfers(self):
+        """After (re)connecting: listen for resend requests again and ask for missing chunks."""
+        with self._transfers_lock:
+            self.expire_transfers()
+            outgoing = list(self.outgoing_transfers.values())
+            incoming = list(self.incoming_transfers.values())
+
+        for transfer in outgoing:
+            self.listen_for_resends(transfer)
+
+        for transfer in incoming:
+            if transfer.reply_topic:
+                properties = Properties(PacketTypes.PUBLISH)
+                properties.ContentType = CHUNK_REQUEST_CONTENT_TYPE
+                request = {"transfer": transfer.id, "missing": transfer.missing()}
+                self.client.publish(transfer.reply_topic, json.dumps(request), 1, False, properties)
+
+    def expire_transfers(self):
+        # Called with _transfers_lock held
+        now = time.time()
+        for transfer_id, transfer in list(self.incoming_transfers.items()):
+            if now - transfer.updated > self.transfer_timeout:
+                del self.incoming_transfers[transfer_id]
+                transfer.close()
+        for transfer_id, transfer in list(self.outgoing_transfers.items()):
+            if transfer.finished is not None and now - transfer.finished > self.transfer_keep:
+                del self.outgoing_transfers[transfer_id]
+                if transfer.topic not in self.subscriptions and not any(
+                        t.reply_topic == transfer.reply_topic for t in self.outgoing_transfers.values()):
+                    self.client.unsubscribe(transfer.reply_topic)
+
+    def transfer_status(self):
+        """Progress of incoming and outgoing chunked transfers."""
+        with self._transfers_lock:
+            return {
+                "incoming": [{"transfer": t.id, "topic": t.topic, "received_bytes": t.received_bytes,
+                              "size": t.size, "missing_chunks": t.chunks - t.received_count}
+                             for t in self.incoming_transfers.values()],
+                "outgoing": [{"transfer": t.id, "topic": t.topic, "size": len(t.payload),
+                              "finished": t.finished is not None, "resent_chunks": t.resent}
+                             for t in self.outgoing_transfers.values()],
+            }
+
+    def apply_patch_message(self, topic, patch_payload, properties):
+        """Rebuild the full document from a merge patch and the cached document.
+
+        Returns None if the cached document is not the one the patch was made
+        against, the message is then dropped.
+        """
+        props = user_properties(properties)
+        # A disk entry is safe here, it is only used if its digest matches
+        entry = self.cache_entry(topic, from_disk=True)
+        if entry is not None:
+            digest = payload_digest(entry.payload)
+
+            # Our own update coming back, the cache already holds the result
+            if digest == props.get("dataspace-result"):
+                return entry.payload
+
+            if digest == props.get("dataspace-base"):
+                try:
+                    doc = apply_merge_patch(json.loads(entry.payload), json.loads(patch_payload))
+                    self.patch_stats["applied"] += 1
+                    return json.dumps(doc).encode("utf-8")
+                except Exception:
+                    traceback.print_exc()
+
+        self.patch_stats["skipped"] += 1
+        self.DebugPrint(f"Dropped merge patch for {topic}, cached document does not match its base")
+        return None
+
+    def DebugPrint(self, message, force=False):
+        if self.debug or force:
+            print(message)
+
+    def deliver(self, topic, topic_filters, payload, msg_type: message_type, properties=None, received=None):
+        """Call all handlers subscribed through topic_filters with one message."""
+        to_be_unsubscribed = []
+
+        # Decode the payload at most once and evaluate every distinct
+        # jsonpath once, handlers using the same path share the result
+        view = None
+        results = {None: payload}
+        messages = {}   # jsonpath → Message, shared by all message handlers
+        url = None
+
+        for topic_filter in topic_filters:
+            for (handler, jsonpath, as_message) in self.subscriptions.get(topic_filter):
+
+                if jsonpath in results:
+                    msg_payload = results[jsonpath]
+                else:
+                    if view is None:
+                        view = PayloadView(topic, payload, properties, self.payload_decoders)
+                    msg_payload = self.ApplyJsonPath(payload, jsonpath, view.json_value())
+                    results[jsonpath] = msg_payload
+
+                if callable(handler):
+                    try:
+                        if as_message:
+                            message = messages.get(jsonpath)
+                            if message is None:
+                                message = messages[jsonpath] = Message(
+                                    topic, self.broker, msg_payload, msg_type, received, properties,
+                                    jsonpath, view if jsonpath is None else None, self.payload_decoders)
+                            handler(message)
+                        else:
+                            if url is None:
+                                url = "mqtt://" + self.broker + "/" + topic
+                            handler(url, msg_payload, msg_type)
+                    except:
+                        traceback.print_exc()
+
+                if topic_filter in self.gets:
+                    get_obj = self._pop_get(topic_filter, handler)
+                    if get_obj is not None:
+                        to_be_unsubscribed.append(get_obj)
+
+        for get_obj in to_be_unsubscribed:
+            if get_obj.timer is not None:
+                get_obj.timer.cancel()
+            self.Unsubscribe(get_obj.topic, get_obj.update)
+
+    def start_dispatcher(self, workers=4):
+        """Run handlers on a worker pool instead of the paho network thread.
+
+        Messages on the same topic are still delivered in arrival order.
+        workers=0 goes back to calling handlers on the network thread.
+        """
+        old = self.dispatcher
+        self.dispatcher = Dispatcher(workers) if workers > 0 else None
+        if old is not None:
+            old.close()
+
     def find(self,name,handler=default_handler,basepath = None):
         if basepath ==None:
             basepath = self.basepath + "/"
@@ -660,6 +3781,50 @@ class DataHub:
 
         self.debug = False
 
+        # Number of handler worker threads per server, 0 runs handlers on the network thread
+        self.dispatch_workers = 0
+
+        # QoS>0 messages in flight per server, fixed once a server is connected
+        self.max_inflight = 100
+
+        # Send JSONPath updates as merge patches (all clients of the topic must support it)
+        self.delta_updates = False
+
+        # Seconds the servers keep our session (subscriptions, queued QoS 1
+        # messages) after a disconnect, None starts a clean session every time.
+        # Each process starts with a clean session, it is resumed on reconnects.
+        self.session_expiry = None
+
+        # Shared on-disk cache for all servers, see enable_persistent_cache
+        self.persistent_cache = None
+
+        # (encoding, threshold, level) for published payloads, see enable_compression
+        self.compression = None
+
+        # Publish sends payloads larger than this in chunks (receivers must support it),
+        # retained publishes are always sent whole
+        self.chunk_threshold = None
+
+        # callable(topic, received_bytes, total_bytes) for incoming chunked transfers
+        self.transfer_progress = None
+
+    def enable_persistent_cache(self, path=None, max_age=7 * 24 * 3600):
+        """Keep received payloads on disk so a new process starts with a warm cache.
+
+        Disk entries are only used by Get(max_age=...) (and GetMany), which
+        checks their age. Subscribe, plain Get and JSONPath updates always
+        wait for the server.
+
+        Args:
+            path:    Cache directory, defaults to ~/.dataspace/cache.
+            max_age: Entries older than this many seconds are not used (None = no limit).
+        """
+        if self.persistent_cache is None:
+            self.persistent_cache = PersistentCache(path, max_age=max_age)
+            for server in self.servers.values():
+                server.persistent_cache = self.persistent_cache
+        return self.persistent_cache
+
     def add_credentials(self, server, username, password):
 
         """Store credentials for a server. There is no connection make until a get, subscribe or publish is done.
@@ -763,8 +3928,16 @@ class DataHub:
             self.DebugPrint(f"No credentials found for server: {server_adress}")
             credentials = {"user": None, "password": None}
 
-        server = Broker(broker=server_adress,port=1883,user=credentials["user"],passw=credentials["password"],basepath="datadirectory")
+        server = Broker(broker=server_adress,port=1883,user=credentials["user"],passw=credentials["password"],basepath="datadirectory",
+                        dispatch_workers=self.dispatch_workers, persistent_cache=self.persistent_cache,
+                        max_inflight=self.max_inflight,
+                        session_expiry=self.session_expiry)
         server.debug = self.debug
+        server.delta_updates = self.delta_updates
+        if self.compression is not None:
+            server.enable_compression(*self.compression)
+        server.chunk_threshold = self.chunk_threshold
+        server.transfer_progress = self.transfer_progress
 
         self.DebugPrint(f"Server {server_adress} added")
 
@@ -800,11 +3973,69 @@ class DataHub:
 
         self.DebugPrint("Subscribing to: " + path)
 
-        server.Subscribe(path,callback)
+        # Subscription id, can be passed to Unsubscribe instead of url and callback
+        return server.Subscribe(path,callback)
+
 
+    def SubscribeMany(self, urls, callback=default_handler, wait_retained=True):
+        """Subscribe callback to many urls with few SUBSCRIBE packets per server.
+
+        Returns:
+            concurrent.futures.Future: Resolves to {url: reason code} when every
+            server has acknowledged (and, with wait_retained, sent retained values).
+        """
+        return self._many(urls, lambda server, topics: server.SubscribeMany(topics, callback, wait_retained))
+
+    def UnsubscribeMany(self, urls, callback=default_handler):
+        """Unsubscribe callback from many urls, see SubscribeMany."""
+        return self._many(urls, lambda server, topics: server.UnsubscribeMany(topics, callback))
+
+    def _many(self, urls, call):
+        # Group by server, call once per server and join the futures into one
+        by_server = {}
+        for url in urls:
+            server_adress, topic = self.SplitPath(url)
+            server = self.add_server(server_adress)
+            if server == None:
+                self.DebugPrint(f"Could not connect to {server_adress}")
+                continue
+            by_server.setdefault(server, []).append((url, topic))
+
+        result = concurrent.futures.Future()
+        parts = [(server, items, call(server, [topic for _, topic in items])) for server, items in by_server.items()]
+        remaining = [len(parts)]
+        lock = threading.Lock()
+        codes = {}
+
+        def part_done(server, items, future):
+            server_codes = future.result()
+            with lock:
+                for url, topic in items:
+                    topic_root, _ = server.parse_topic_jsonpath(topic)
+                    if topic_root in server_codes:
+                        codes[url] = server_codes[topic_root]
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if finished:
+                result.set_result(codes)
+
+        if not parts:
+            result.set_result({})
+        for server, items, future in parts:
+            future.add_done_callback(lambda f, server=server, items=items: part_done(server, items, f))
+        return result
 
     def Unsubscribe(self,url,callback=default_handler):
 
+        # Unsubscribe by subscription id, ids are unique across servers
+        if isinstance(url, int):
+            for server in self.servers.values():
+                if server.subscriptions.by_id(url) is not None:
+                    server.Unsubscribe(url)
+                    self.DebugPrint(f"Unsubscribed subscription {url}")
+                    return
+            return
+
         self.DebugPrint("Unsubscribing from: " + url)
 
         server_adress,path = self.SplitPath(url)
@@ -821,7 +4052,15 @@ class DataHub:
 
         self.DebugPrint("Unsubscribed from: " + path)
 
-    def Get(self, url, blocking=True, handler=default_handler, timeout=10):
+    def Get(self, url, blocking=True, handler=default_handler, timeout=10, max_age=None):
+        """Get the current value of url.
+
+        Args:
+            timeout: Seconds to wait, "auto" adapts to the server's measured
+                     answer times (at most 10 s).
+            max_age: If given, a cached value at most this many seconds old is
+                     returned directly without asking the server.
+        """
 
         server_adress,topic = self.SplitPath(url)
 
@@ -831,9 +4070,72 @@ class DataHub:
             self.DebugPrint(f"Could not connect to {server_adress}")
             return
 
-        return server.Get(topic, blocking=blocking, handler=handler, timeout=timeout)
+        return server.Get(topic, blocking=blocking, handler=handler, timeout=timeout, max_age=max_age)
     
 
+    def GetToFile(self, url, path, timeout=10, max_age=None):
+        """Get url and write the payload to path.
+
+        The payload is written straight from the received buffer, no extra
+        copy is made. Returns the number of bytes written, None on timeout.
+        """
+        server_adress, topic = self.SplitPath(url)
+        server = self.add_server(server_adress)
+        if server == None:
+            self.DebugPrint(f"Could not connect to {server_adress}")
+            return None
+        return server.GetToFile(topic, path, timeout=timeout, max_age=max_age)
+
+    def GetArray(self, url, dtype="uint8", count=-1, offset=0, timeout=10, max_age=None):
+        """Get url as a numpy array (np.frombuffer) without copying the payload.
+
+        The array is read-only since it shares memory with the cached payload.
+        Needs numpy. Returns None on timeout.
+        """
+        server_adress, topic = self.SplitPath(url)
+        server = self.add_server(server_adress)
+        if server == None:
+            self.DebugPrint(f"Could not connect to {server_adress}")
+            return None
+        return server.GetArray(topic, dtype=dtype, count=count, offset=offset, timeout=timeout, max_age=max_age)
+
+    def GetMany(self, urls, timeout=10, max_age=None):
+        """Get several urls, possibly on different servers, with one overall deadline.
+
+        Subscriptions for all urls are issued before anything is waited for, so the
+        total time is roughly one round-trip instead of one per url.
+
+        Args:
+            urls:    Iterable of mqtt:// urls, optionally with a JSONPath.
+            timeout: Seconds to wait in total.
+            max_age: If given, cached values at most this many seconds old are used.
+
+        Returns:
+            dict: {url: payload}, urls without an answer map to GET_TIMEOUT.
+        """
+        deadline = time.time() + timeout
+        by_server = {}
+        results = {}
+
+        for url in urls:
+            server_adress, topic = self.SplitPath(url)
+            server = self.add_server(server_adress)
+            if server == None:
+                self.DebugPrint(f"Could not connect to {server_adress}")
+                results[url] = GET_TIMEOUT
+                continue
+            by_server.setdefault(server, []).append((url, topic))
+
+        pending = [(server, items, server.start_gets((topic for _, topic in items), max_age))
+                   for server, items in by_server.items()]
+
+        for server, items, gets in pending:
+            payloads = server.collect_gets(gets, deadline)
+            for url, topic in items:
+                results[url] = payloads[topic]
+
+        return results
+
     def add_user_with_role(self, server_url,  
                        username, password, fullname=None,
                        create_user_dir=True):
@@ -924,6 +4226,107 @@ class DataHub:
         
 
 
+    def PublishMany(self, items, qos=0, retain=False, timeout=None):
+        """Publish many messages through each server's background publisher.
+
+        Args:
+            items:   Iterable of (url, payload) or (url, payload, qos, retain[, properties]).
+            timeout: Max seconds to block on a full outgoing queue, None waits forever.
+
+        Returns:
+            int: Number of messages queued.
+        """
+        count = 0
+        for item in items:
+            server_adress, topic = self.SplitPath(item[0])
+            server = self.add_server(server_adress)
+            if server == None:
+                self.DebugPrint(f"Could not connect to {server_adress}")
+                continue
+            count += server.PublishMany([(topic,) + tuple(item[1:])], qos, retain, timeout)
+        return count
+
+    def set_publish_rate(self, url, min_interval=None, rate=None, burst=1):
+        """Rate limit publishing to every topic starting with url.
+
+        Publish calls are unchanged; values sent faster than min_interval (or
+        rate/burst) are coalesced so only the newest one is published.
+        Pending values are sent by close().
+        """
+        server_adress, path = self.SplitPath(url)
+        server = self.add_server(server_adress)
+        if server == None:
+            self.DebugPrint(f"Could not connect to {server_adress}")
+            return
+        server.set_publish_rate(path, min_interval=min_interval, rate=rate, burst=burst)
+
+    def PublishChunked(self, url, payload, chunk_size=None, qos=1, progress=None, timeout=None):
+        """Publish a large payload in chunks, see Broker.PublishChunked.
+
+        Args:
+            progress: callable(sent_bytes, total_bytes).
+            timeout:  Max seconds for the whole transfer, None waits forever.
+
+        Returns:
+            str: Transfer id, None if the server could not be reached.
+        """
+        server_adress, topic = self.SplitPath(url)
+        server = self.add_server(server_adress)
+        if server == None:
+            self.DebugPrint(f"Could not connect to {server_adress}")
+            return None
+        return server.PublishChunked(topic, payload, chunk_size=chunk_size, qos=qos, progress=progress, timeout=timeout)
+
+    def enable_compression(self, encoding="zlib", threshold=1024, level=None):
+        """Compress published payloads larger than threshold bytes on all servers.
+
+        Args:
+            encoding:  "zlib" or "zstd" (needs the zstandard package), None turns it off.
+            threshold: Smaller payloads are sent as they are.
+            level:     Compression level, None uses the codec default.
+        """
+        self.compression = (encoding, threshold, level)
+        for server in self.servers.values():
+            server.enable_compression(*self.compression)
+
+    def compression_stats(self):
+        """Per-topic compression stats for every server."""
+        return {name: server.compression_stats() for name, server in self.servers.items()}
+
+    def wait_connected(self, url=None, timeout=None):
+        """Wait until the server of url (or every added server) is connected.
+
+        Connections are opened in the background, this is only needed when
+        something must not start before the connection is up.
+
+        Returns:
+            bool: False if timeout passed first.
+        """
+        if url is not None:
+            server_adress, _ = self.SplitPath(url)
+            server = self.add_server(server_adress)
+            return server is not None and server.wait_connected(timeout)
+
+        deadline = None if timeout is None else time.time() + timeout
+        for server in list(self.servers.values()):
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            if not server.wait_connected(remaining):
+                return False
+        return True
+
+    def get_stats(self):
+        """Get hit/timeout counters and adaptive deadlines per server."""
+        return {name: server.get_stats() for name, server in self.servers.items()}
+
+    def close(self, timeout=10):
+        """Flush pending publishes and disconnect from all servers."""
+        for server in list(self.servers.values()):
+            server.close(timeout)
+        self.servers.clear()
+        if self.persistent_cache is not None:
+            self.persistent_cache.close(timeout)
+            self.persistent_cache = None
+
     def GetCache(self,url):
         server_adress,topic = self.SplitPath(url)
 
@@ -950,6 +4353,147 @@ class DataHub:
 
 
 
+# Asyncio implementation
+
+class AsyncSubscription:
+    """Async iterator over (url, payload, msg_type) for one subscription.
+
+    Paho callbacks are handed to the event loop with call_soon_threadsafe,
+    no thread is used per subscription.
+    """
+
+    def __init__(self, broker, topic, loop, maxsize=0):
+        self._broker = broker
+        self._topic = topic
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize)
+        self._closed = False
+        broker.Subscribe(topic, self._on_message)
+
+    def _on_message(self, url, payload, msg_type: message_type):
+        self._loop.call_soon_threadsafe(self._put, (url, payload, msg_type))
+
+    def _put(self, item):
+        if self._queue.full():
+            # Keep the newest values if the consumer falls behind
+            self._queue.get_nowait()
+        self._queue.put_nowait(item)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        item = await self._queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._broker.Unsubscribe(self._topic, self._on_message)
+            # Wake up a consumer waiting in __anext__, a full queue
+            # drops its oldest value to make room for the sentinel
+            self._put(None)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+class AsyncBroker:
+    """asyncio facade over a Broker.
+
+    await get() waits on an asyncio future completed from the paho thread,
+    so any number of gets can be outstanding without extra threads.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    async def get(self, topic, timeout=10):
+        """Return the next payload for topic, or None on timeout."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def set_result(item):
+            if not future.done():
+                future.set_result(item)
+
+        def on_message(url, payload, msg_type: message_type):
+            loop.call_soon_threadsafe(set_result, payload)
+
+        self.broker.Subscribe(topic, on_message)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.broker.Unsubscribe(topic, on_message)
+
+    async def get_many(self, topics, timeout=10):
+        """Get several topics concurrently, returns {topic: payload or None}."""
+        topics = list(topics)
+        results = await asyncio.gather(*(self.get(t, timeout) for t in topics))
+        return dict(zip(topics, results))
+
+    def subscribe(self, topic, maxsize=0):
+        """Return an AsyncSubscription, use with async for (and async with)."""
+        return AsyncSubscription(self.broker, topic, asyncio.get_running_loop(), maxsize)
+
+    async def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.broker.Publish(topic, payload, qos, retain, properties)
+
+
+class AsyncDataHub:
+    """asyncio facade over a DataHub, takes the same mqtt:// urls.
+
+    Example:
+        hub = AsyncDataHub(datahub)
+        value = await hub.get("mqtt://host/datadirectory/a.json$.temp")
+        async for url, payload, msg_type in hub.subscribe("mqtt://host/datadirectory/a/#"):
+            ...
+    """
+
+    def __init__(self, hub=None):
+        self.hub = hub if hub is not None else datahub
+        self._brokers = {}
+
+    def _server(self, url):
+        server_adress, topic = self.hub.SplitPath(url)
+        server = self.hub.add_server(server_adress)
+        if server is None:
+            raise ValueError(f"Could not connect to {server_adress}")
+
+        async_broker = self._brokers.get(server_adress)
+        if async_broker is None or async_broker.broker is not server:
+            async_broker = self._brokers[server_adress] = AsyncBroker(server)
+        return async_broker, topic
+
+    async def get(self, url, timeout=10):
+        server, topic = self._server(url)
+        return await server.get(topic, timeout)
+
+    async def get_many(self, urls, timeout=10):
+        """Get several urls concurrently, returns {url: payload or None}."""
+        urls = list(urls)
+        results = await asyncio.gather(*(self.get(u, timeout) for u in urls))
+        return dict(zip(urls, results))
+
+    def subscribe(self, url, maxsize=0):
+        server, topic = self._server(url)
+        return server.subscribe(topic, maxsize)
+
+    async def publish(self, url, payload=None, qos=0, retain=False, properties=None):
+        server, topic = self._server(url)
+        await server.publish(topic, payload, qos, retain, properties)
+
+
+
 
 
 import json
@@ -1015,6 +4559,10 @@ class DynSec:
             cmd.update(data)
         payload = {"commands": [cmd]}
 
+        # Anslutningen öppnas i bakgrunden, vänta innan något registreras
+        if not self.broker.wait_connected(timeout):
+            raise TimeoutError("Not connected to the broker")
+
         # registrera väntaren FÖRE publish
         evt = threading.Event()
         self._waiters[corr] = evt
@@ -23,10 +23,15 @@ setup(
         'vis': [
             'trimesh>=4.4.9',
         ],
+        # zstd-komprimering av payloads (zlib fungerar utan)
+        'zstd': [
+            'zstandard',
+        ],
         # allt
         'all': [
             'pandas>=2.2.2,<3.0',
-            'trimesh>=4.4.9'
+            'trimesh>=4.4.9',
+            'zstandard',
         ],
     },
     classifiers=[
@@ -0,0 +1,38 @@
+# Run: python -m pytest tests
+# Uses an offline Broker (connect=False), no MQTT server is needed.
+
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from dataspace_client import Broker
+
+
+def make_broker():
+    broker = Broker("localhost", 1883, None, None, "datadirectory", connect=False)
+    broker.update_flush_window = 0.01
+    broker.cache_payload("datadirectory/doc", b'{"a": 0, "b": 0}')
+    return broker
+
+
+def test_quick_path_updates_to_the_same_document_are_not_lost():
+    broker = make_broker()
+    published = []
+    done = threading.Event()
+
+    def send_publish(topic, payload=None, qos=0, retain=False, properties=None):
+        published.append(json.loads(payload))
+        if len(published) == 1:
+            # Arrives while the first update is being published
+            broker.Publish("datadirectory/doc$.b", 2)
+        else:
+            done.set()
+
+    broker.send_publish = send_publish
+    broker.Publish("datadirectory/doc$.a", 1)
+
+    assert done.wait(5)
+    assert published == [{"a": 1, "b": 0}, {"a": 1, "b": 2}]
+    assert json.loads(broker.get_cached("datadirectory/doc")) == {"a": 1, "b": 2}